@@ -10,5 +10,6 @@ admin.site.register(Shuttlecock)
 admin.site.register(Review)
 admin.site.register(Document)
 admin.site.register(Schedule)
+admin.site.register(ArchivedSchedule)
 admin.site.register(Image)
 admin.site.register(Booking)
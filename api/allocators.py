@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import slot_mask
+
+
+# An allocator takes a court, the {court_number: status} of the requested
+# date and the requested slots, and returns the free court_numbers in the
+# order Court.book should try to claim them.
+
+
+def first_fit(court, statuses, start, end):
+    mask = slot_mask(start, end)
+    return [court_number for court_number, status in sorted(statuses.items())
+            if status & mask == 0]
+
+
+def free_gap(status, start, end, first, last):
+    # length of the run of free slots around start..end, within first..last
+    low = start
+    while low > first and (status >> (low - 1)) & 1 == 0:
+        low -= 1
+    high = end
+    while high < last and (status >> (high + 1)) & 1 == 0:
+        high += 1
+    return high - low + 1
+
+
+def best_fit(court, statuses, start, end):
+    # the court_number whose free gap is the tightest fit goes first, which
+    # keeps long free gaps for long bookings
+    last = min(court.close, 47)
+    candidates = first_fit(court, statuses, start, end)
+    return sorted(candidates, key=lambda court_number: (
+        free_gap(statuses[court_number], start, end, court.open, last),
+        court_number,
+    ))
+
+
+def get_allocator():
+    return import_string(settings.COURT_ALLOCATOR)
@@ -0,0 +1,358 @@
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, F, FilteredRelation, IntegerField, \
+    OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import ArchivedSchedule, Court, Racket, Schedule, slot_mask
+
+
+def booking_dates(today=None):
+    # the dates that have schedule rows and can be booked
+    if today is None:
+        today = timezone.localdate()
+    return [today + timedelta(days=i) for i in range(0, settings.BOOKING_HORIZON_DAYS)]
+
+
+def next_date(day_of_the_week, today=None):
+    # the first date on or after today that falls on day_of_the_week
+    if today is None:
+        today = timezone.localdate()
+    return today + timedelta(days=(day_of_the_week - today.weekday()) % 7)
+
+
+Availability = namedtuple('Availability', ['version', 'dates', 'courts'])
+# Availability.courts is {date: {court_number: status}}
+
+
+class AvailabilityCache:
+    # LRU of the Availability of recently searched courts for the next
+    # CACHED_DAYS days. An entry is only used while its version matches
+    # Court.availability_version, which every booking change bumps in the
+    # database, so entries of other processes go stale on their own.
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, court, dates):
+        with self.lock:
+            entry = self.entries.get(court.id)
+            if entry is None or entry.version != court.availability_version \
+                    or entry.dates != dates:
+                return None
+            self.entries.move_to_end(court.id)
+            return entry
+
+    def put(self, court_id, entry):
+        with self.lock:
+            self.entries[court_id] = entry
+            self.entries.move_to_end(court_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, court_id):
+        with self.lock:
+            self.entries.pop(court_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+CACHED_DAYS = 7
+
+availability_cache = AvailabilityCache(settings.AVAILABILITY_CACHE_SIZE)
+
+
+def load_availability(courts, dates):
+    # {court id: Availability} read from the database in two queries
+    courts = list(courts)
+    # the versions are read before the masks, so that a booking made in
+    # between can only make the entry look older than it is
+    versions = dict(Court.objects.filter(
+        id__in=[court.id for court in courts],
+    ).values_list('id', 'availability_version'))
+    result = {
+        court.id: Availability(versions.get(court.id), dates,
+                               {date: {} for date in dates})
+        for court in courts
+    }
+    schedules = Schedule.objects.filter(
+        court__in=courts, date__in=dates,
+    ).values_list('court_id', 'court_number', 'date', 'status')
+    for court_id, court_number, date, status in schedules:
+        result[court_id].courts[date][court_number] = status
+    return result
+
+
+def get_availability(courts, date):
+    # {court id: Availability covering date}, from the cache when possible
+    courts = list(courts)
+    dates = tuple(booking_dates()[:CACHED_DAYS])
+    if date not in dates:
+        return load_availability(courts, (date,))
+    result = {}
+    missing = []
+    for court in courts:
+        entry = availability_cache.get(court, dates)
+        if entry is None:
+            missing.append(court)
+        else:
+            result[court.id] = entry
+    if missing:
+        loaded = load_availability(missing, dates)
+        # what a transaction reads may be rolled back, with the version it
+        # bumped taken again by another booking, so it is not shared
+        if not transaction.get_connection().in_atomic_block:
+            for court_id, entry in loaded.items():
+                availability_cache.put(court_id, entry)
+        result.update(loaded)
+    return result
+
+
+def invalidate_availability(court_id):
+    Court.objects.filter(pk=court_id).update(
+        availability_version=F('availability_version') + 1)
+    availability_cache.discard(court_id)
+
+
+def court_statuses(courts, date):
+    # {court id: {court_number: status}} of date for every court
+    courts = list(courts)
+    availability = get_availability(courts, date)
+    return {court.id: availability[court.id].courts[date] for court in courts}
+
+
+def free_racket_schedules(date, start, end):
+    # the racket schedules of date that are free from start to end; a racket
+    # without a row for the date cannot be booked on it
+    return Schedule.objects.filter(
+        racket__isnull=False, date=date,
+    ).annotate(
+        collision=F('status').bitand(slot_mask(start, end)),
+    ).filter(collision=0)
+
+
+def free_racket_count(date, start, end):
+    # expression counting the free rackets of the outer court
+    return Coalesce(Subquery(
+        free_racket_schedules(date, start, end).filter(
+            racket__court=OuterRef('pk'),
+        ).order_by().values('racket__court').annotate(count=Count('id')).values('count'),
+        output_field=IntegerField(),
+    ), 0)
+
+
+def free_court_count(date, start, end):
+    # expression counting the free court_numbers of the outer court
+    return Coalesce(Subquery(
+        Schedule.objects.filter(
+            court=OuterRef('pk'), date=date,
+        ).annotate(
+            collision=F('status').bitand(slot_mask(start, end)),
+        ).filter(collision=0).order_by().values('court').annotate(
+            count=Count('id'),
+        ).values('count'),
+        output_field=IntegerField(),
+    ), 0)
+
+
+def has_free_court(date, start, end):
+    # expression telling whether a court_number of the outer court is free
+    return Exists(Schedule.objects.filter(
+        court=OuterRef('pk'), date=date,
+    ).annotate(
+        collision=F('status').bitand(slot_mask(start, end)),
+    ).filter(collision=0))
+
+
+def free_rackets(courts, date, start, end):
+    # {court id: [free Racket, ...]} for every court, in one query
+    courts = list(courts)
+    result = {court.id: [] for court in courts}
+    rackets = Racket.objects.filter(
+        court__in=courts,
+        id__in=free_racket_schedules(date, start, end).values('racket_id'),
+    ).order_by('id')
+    for racket in rackets:
+        result[racket.court_id].append(racket)
+    return result
+
+
+def run_starts(status, length, first, last):
+    # mask of the slots s in first..last where s..s+length-1 are all free
+    # and end by last
+    free = ~status & slot_mask(first, last)
+    runs = free
+    for shift in range(1, length):
+        runs &= free >> shift
+    return runs
+
+
+def next_free_slots(courts, length, date, start, limit):
+    # the `limit` earliest (court, date, start, free court count) from
+    # date/start on where `length` consecutive slots are free, earlier
+    # courts first on ties
+    courts = list(courts)
+    dates = [day for day in booking_dates() if day >= date]
+    cached = tuple(booking_dates()[:CACHED_DAYS])
+    now = timezone.localtime(timezone.now())
+    uncached = None
+    found = []
+    for day in dates:
+        if day in cached:
+            statuses = court_statuses(courts, day)
+        else:
+            if uncached is None:
+                # the days after the cached week are read in one go
+                uncached = load_availability(courts, tuple(d for d in dates if d not in cached))
+            statuses = {court.id: uncached[court.id].courts[day] for court in courts}
+        first = start if day == date else 0
+        if day == now.date():
+            first = max(first, now.hour * 2 + (now.minute >= 30))
+        candidates = []
+        for index, court in enumerate(courts):
+            low = max(first, court.open)
+            high = min(court.close, 47)
+            if low > high:
+                continue
+            runs = [run_starts(status, length, low, high)
+                    for status in statuses[court.id].values()]
+            starts = 0
+            for run in runs:
+                starts |= run
+            for slot in range(low, high + 1):
+                if (starts >> slot) & 1:
+                    free = sum(1 for run in runs if (run >> slot) & 1)
+                    candidates.append((slot, index, court, free))
+        candidates.sort(key=lambda candidate: candidate[:2])
+        for slot, _, court, free in candidates[:limit - len(found)]:
+            found.append((court, day, slot, free))
+        if len(found) >= limit:
+            break
+    return found
+
+
+def free_slots(status, first=0, last=47):
+    # the slot numbers from first to last whose bit is not set
+    return [slot for slot in range(first, last + 1) if (status >> slot) & 1 == 0]
+
+
+def weekly_availability(court):
+    # free court counts per slot and free racket slots of the cached days
+    dates = booking_dates()[:CACHED_DAYS]
+    availability = get_availability([court], dates[0])[court.id]
+    last = min(court.close, 47)
+    now = timezone.localtime(timezone.now())
+    # the slots of today that have passed cannot be booked any more
+    firsts = {date: max(court.open, now.hour * 2 + (now.minute >= 30)) if date == now.date()
+              else court.open for date in dates}
+    courts = []
+    for date in dates:
+        statuses = availability.courts[date].values()
+        counts = [0] * 48
+        for slot in range(firsts[date], last + 1):
+            counts[slot] = sum(1 for status in statuses if (status >> slot) & 1 == 0)
+        courts.append(counts)
+    rackets = Racket.objects.filter(court=court).annotate(
+        dated_schedule=FilteredRelation(
+            'schedules',
+            condition=Q(schedules__date__in=dates),
+        ),
+        schedule_date=F('dated_schedule__date'),
+        schedule_status=F('dated_schedule__status'),
+    ).order_by('id')
+    statuses = {}
+    for racket in rackets:
+        statuses.setdefault(racket.id, (racket, {}))[1][racket.schedule_date] = \
+            racket.schedule_status
+    rackets = []
+    for racket, racket_statuses in statuses.values():
+        rackets.append({
+            'id': racket.id,
+            'name': racket.name,
+            'free_slots': [
+                [] if racket_statuses.get(date) is None
+                else free_slots(racket_statuses[date], firsts[date], last)
+                for date in dates
+            ],
+        })
+    return {
+        'dates': dates,
+        'courts': courts,
+        'rackets': rackets,
+    }
+
+
+def provision_schedules(courts=(), rackets=(), dates=None, batch_size=None):
+    # create the missing Schedule rows of the given courts and rackets
+    courts = list(courts)
+    rackets = list(rackets)
+    if dates is None:
+        dates = booking_dates()
+    existing = set(Schedule.objects.filter(
+        Q(court__in=courts) | Q(racket__in=rackets),
+        date__in=dates,
+    ).values_list('court_id', 'racket_id', 'court_number', 'date'))
+    schedules = []
+    for court in courts:
+        for date in dates:
+            for court_number in range(0, court.court_count):
+                if (court.id, None, court_number, date) not in existing:
+                    schedules.append(Schedule(court=court, court_number=court_number,
+                                              date=date, day_of_the_week=date.weekday()))
+    for racket in rackets:
+        for date in dates:
+            if (None, racket.id, None, date) not in existing:
+                schedules.append(Schedule(racket=racket, date=date,
+                                          day_of_the_week=date.weekday()))
+    # another process (a concurrent save, rollover_schedules) may create
+    # some of them after the read above
+    Schedule.objects.bulk_create(schedules, batch_size=batch_size, ignore_conflicts=True)
+    return len(schedules)
+
+
+def surplus_bookings(court_id, court_count):
+    # the court_numbers from court_count up that are booked from today on
+    return sorted(set(Schedule.objects.filter(
+        court_id=court_id, court_number__gte=court_count, date__gte=timezone.localdate(),
+    ).exclude(status=0).values_list('court_number', flat=True)))
+
+
+def reconcile_schedules(court):
+    # the rows of court_numbers 0..court_count-1 on every bookable date, and
+    # none above but the booked ones, which Court.clean and CourtSerializer
+    # keep from being dropped
+    removed, _ = Schedule.objects.filter(
+        court=court, court_number__gte=court.court_count, status=0,
+    ).delete()
+    created = provision_schedules(courts=[court])
+    if removed or created:
+        invalidate_availability(court.id)
+
+
+def archive_schedules(before, batch_size=1000):
+    # move the rows of dates before `before` out of the Schedule table
+    archived = 0
+    while True:
+        schedules = list(Schedule.objects.filter(date__lt=before).order_by('id')[:batch_size])
+        if not schedules:
+            break
+        with transaction.atomic():
+            # rows that were never booked are not worth keeping
+            ArchivedSchedule.objects.bulk_create([
+                ArchivedSchedule(court_id=schedule.court_id, racket_id=schedule.racket_id,
+                                 court_number=schedule.court_number, date=schedule.date,
+                                 status=schedule.status)
+                for schedule in schedules if schedule.status != 0
+            ])
+            Schedule.objects.filter(id__in=[schedule.id for schedule in schedules]).delete()
+        archived += len(schedules)
+    return archived
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import ExtendedUser
+
+
+def banned_by_key(user_id):
+    return 'banned_by:%s' % user_id
+
+
+def banned_by(user_id):
+    # ids of the users (court owners) who have user_id in their ban list,
+    # kept in the cache until api.signals.ban_list_changed drops them or
+    # BAN_CACHE_TIMEOUT runs out
+    owners = cache.get(banned_by_key(user_id))
+    if owners is None:
+        owners = frozenset(ExtendedUser.objects.filter(
+            ban_list=user_id,
+        ).values_list('base_user_id', flat=True))
+        cache.set(banned_by_key(user_id), owners, settings.BAN_CACHE_TIMEOUT)
+    return owners
+
+
+def forget_banned_by(user_ids):
+    cache.delete_many([banned_by_key(user_id) for user_id in user_ids])
+
+
+def exclude_banned(queryset, user):
+    # the courts of queryset that user may see
+    if user.is_staff:
+        return queryset
+    owners = banned_by(user.id)
+    if owners:
+        queryset = queryset.exclude(owner_id__in=owners)
+    return queryset
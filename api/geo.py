@@ -0,0 +1,61 @@
+from math import cos, floor, radians
+
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+# Courts are bucketed into GRID_SIZE degree cells; Court.geo_cell is indexed
+# so a radius search only reads the cells its bounding box touches.
+GRID_SIZE = 0.05
+GRID_COLUMNS = int(360 / GRID_SIZE) + 1
+MAX_SEARCH_CELLS = 400
+
+
+def distance_expression(lat, long):
+    # haversine distance in km from (lat, long) to the lat/long columns
+    lat = Value(float(lat), output_field=FloatField())
+    long = Value(float(long), output_field=FloatField())
+    a = Power(Sin(Radians(F('lat') - lat) / 2), 2) + \
+        Cos(Radians(lat)) * Cos(Radians(F('lat'))) * Power(Sin(Radians(F('long') - long) / 2), 2)
+    return 2 * EARTH_RADIUS_KM * ASin(Least(Value(1.0), Sqrt(a)))
+
+
+def grid_row(lat):
+    return floor((lat + 90) / GRID_SIZE)
+
+
+def grid_column(long):
+    return floor((long + 180) / GRID_SIZE)
+
+
+def grid_cell(lat, long):
+    return grid_row(lat) * GRID_COLUMNS + grid_column(long)
+
+
+def bounding_box(lat, long, km):
+    # (min lat, max lat, min long, max long) enclosing the circle
+    d_lat = km / KM_PER_DEGREE
+    d_long = km / (KM_PER_DEGREE * max(cos(radians(lat)), 0.01))
+    return lat - d_lat, lat + d_lat, long - d_long, long + d_long
+
+
+def within_box(queryset, lat, long, km):
+    # prefilter in SQL: the grid cells and coordinates of the bounding box
+    min_lat, max_lat, min_long, max_long = bounding_box(lat, long, km)
+    queryset = queryset.filter(lat__range=(min_lat, max_lat),
+                               long__range=(min_long, max_long))
+    rows = range(grid_row(min_lat), grid_row(max_lat) + 1)
+    columns = range(grid_column(min_long), grid_column(max_long) + 1)
+    if len(rows) * len(columns) <= MAX_SEARCH_CELLS:
+        queryset = queryset.filter(geo_cell__in=[row * GRID_COLUMNS + column
+                                                 for row in rows for column in columns])
+    return queryset
+
+
+def within_distance(queryset, lat, long, km):
+    # courts within km, with their distance annotated, all in SQL
+    return within_box(queryset, lat, long, km).annotate(
+        distance=distance_expression(lat, long),
+    ).filter(distance__lte=km)
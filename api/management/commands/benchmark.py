@@ -0,0 +1,183 @@
+import json
+import platform
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api.availability import availability_cache
+from api.models import Court
+
+
+def percentile(values, q):
+    # q in 0..100 of already sorted values, nearest rank
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def summarize(latencies, queries, statuses):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': sum(1 for code in statuses if code >= 400),
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * 1e3 if latencies else 0,
+            'p50': percentile(latencies, 50) * 1e3,
+            'p90': percentile(latencies, 90) * 1e3,
+            'p99': percentile(latencies, 99) * 1e3,
+            'max': latencies[-1] * 1e3 if latencies else 0,
+        },
+        'queries': {
+            'mean': sum(queries) / len(queries) if queries else 0,
+            'max': max(queries) if queries else 0,
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = 'Time the hot endpoints against the current database and print JSON results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='requests per case')
+        parser.add_argument('--warmup', type=int, default=3, help='untimed requests per case')
+        parser.add_argument('--cases', nargs='+', help='only run these cases')
+        parser.add_argument('--cold', action='store_true',
+                            help='clear the caches before every request')
+        parser.add_argument('--user', help='username to send the requests as')
+        parser.add_argument('--staff', help='staff username for the staff only cases')
+        parser.add_argument('--lat', type=float, default=13.75)
+        parser.add_argument('--long', type=float, default=100.55)
+        parser.add_argument('--output', help='write the results to this file as well')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.user = self.pick_user(options['user'], is_staff=False)
+        self.staff = self.pick_user(options['staff'], is_staff=True)
+        self.client = self.make_client(self.user)
+        self.staff_client = self.make_client(self.staff) if self.staff else None
+        self.courts = list(Court.objects.filter(is_verified=True).values_list('name', flat=True))
+        if not self.courts:
+            raise CommandError('No verified court, run `manage.py generate_data` first')
+        self.bookings = []
+
+        cases = self.cases()
+        if options['cases']:
+            unknown = set(options['cases']) - set(cases)
+            if unknown:
+                raise CommandError('Unknown cases: %s' % ', '.join(sorted(unknown)))
+            cases = {name: cases[name] for name in options['cases']}
+
+        results = {}
+        for name, (client, request) in cases.items():
+            if client is None:
+                continue
+            results[name] = self.run_case(client, request)
+        output = json.dumps({
+            'started': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'courts': len(self.courts),
+            'cold': options['cold'],
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def pick_user(self, username, is_staff):
+        users = User.objects.filter(is_staff=is_staff, extended__isnull=False)
+        if username:
+            users = User.objects.filter(username=username)
+        return users.order_by('id').first()
+
+    def make_client(self, user):
+        client = APIClient(SERVER_NAME='localhost')
+        client.force_authenticate(user)
+        return client
+
+    def cases(self):
+        # name: (client, function returning (method, path, data))
+        rng = self.rng
+        lat, long = self.options['lat'], self.options['long']
+
+        def day():
+            return (timezone.localdate() + timedelta(days=rng.randint(3, 6))).isoformat()
+
+        def slot():
+            start = rng.randint(16, 40)
+            return start, start + rng.choice([1, 2, 3])
+
+        def list_slot():
+            start, end = slot()
+            return 'get', '/api/court/', {'date': day(), 'start_time': start, 'end_time': end}
+
+        def list_rackets():
+            start, end = slot()
+            return 'get', '/api/court/', {'date': day(), 'start_time': start, 'end_time': end,
+                                          'rackets_count': 1}
+
+        def book():
+            start, end = slot()
+            return 'post', '/api/court/%s/book/' % rng.choice(self.courts), \
+                   {'date': day(), 'start': start, 'end': end}
+
+        def cancel():
+            if not self.bookings:
+                return None
+            return 'post', '/api/booking/%d/cancel/' % self.bookings.pop(), {}
+
+        return {
+            'court_list': (self.client, lambda: ('get', '/api/court/', {})),
+            'court_list_name': (self.client, lambda: (
+                'get', '/api/court/', {'name': rng.choice(self.courts).split(' ')[0][:4]})),
+            'court_list_rating': (self.client, lambda: ('get', '/api/court/', {'rating': 4})),
+            'court_list_dist': (self.client, lambda: (
+                'get', '/api/court/', {'dist': 5, 'lat': lat + rng.uniform(-0.05, 0.05),
+                                       'long': long + rng.uniform(-0.05, 0.05), 'sort_by': 'dist'})),
+            'court_list_slot': (self.client, list_slot),
+            'court_list_rackets': (self.client, list_rackets),
+            'court_list_shuttlecocks': (self.client, lambda: (
+                'get', '/api/court/', {'shuttlecocks_count': 50})),
+            'court_book': (self.client, book),
+            'booking_cancel': (self.client, cancel),
+            'user_retrieve': (self.client, lambda: ('get', '/api/user/%s/' % self.user.username, {})),
+            'log_list': (self.client, lambda: ('get', '/api/log/', {})),
+            'log_list_staff': (self.staff_client, lambda: ('get', '/api/log/', {})),
+        }
+
+    def run_case(self, client, request):
+        latencies = []
+        queries = []
+        statuses = []
+        for i in range(self.options['warmup'] + self.options['requests']):
+            call = request()
+            if call is None:
+                break
+            method, path, data = call
+            if self.options['cold']:
+                cache.clear()
+                availability_cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                began = time.perf_counter()
+                response = getattr(client, method)(path, data)
+                elapsed = time.perf_counter() - began
+            if method == 'post' and response.status_code == 200 and 'booking_id' in response.data:
+                # booked courts are cancelled by the booking_cancel case
+                self.bookings.append(response.data['booking_id'])
+            if i < self.options['warmup']:
+                continue
+            latencies.append(elapsed)
+            queries.append(len(captured))
+            statuses.append(response.status_code)
+        return summarize(latencies, queries, statuses)
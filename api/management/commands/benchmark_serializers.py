@@ -0,0 +1,94 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, OuterRef, Subquery
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Court, ExtendedUser, Image
+from api.projections import COURT_VALUES, court_details, court_list, court_list_values, \
+    user_profiles
+from api.renderers import FastJSONRenderer, orjson
+from api.serializers import CourtListSerializer, CourtSerializer, ExtendedUserSerializer
+
+from .benchmark import summarize
+
+
+class Command(BaseCommand):
+    help = 'Compare the serializers with the values() projections of the fast read path ' \
+           'and print JSON results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='runs per case and path')
+        parser.add_argument('--page-size', type=int, default=20, help='courts of the list case')
+        parser.add_argument('--user', help='username of the user_profile case, the one '
+                                           'with the most bookings if not set')
+        parser.add_argument('--output', help='write the results to this file as well')
+
+    def handle(self, *args, **options):
+        court = Court.objects.filter(is_verified=True).order_by('-rating_count', 'id').first()
+        if court is None:
+            raise CommandError('No verified court, run `manage.py generate_data` first')
+        users = ExtendedUser.objects.all()
+        if options['user']:
+            users = users.filter(base_user__username=options['user'])
+        user = users.annotate(booking_count=Count('base_user__bookings')).order_by(
+            '-booking_count', 'id').first()
+        if user is None:
+            raise CommandError('No user found')
+
+        courts = Court.objects.filter(is_verified=True).order_by('name', 'id').annotate(
+            first_image=Subquery(Image.objects.filter(court=OuterRef('pk')).order_by(
+                'timestamp', 'id').values('url')[:1]))[:options['page_size']]
+        cases = {
+            'court_list': (
+                lambda: CourtListSerializer(courts.all(), many=True).data,
+                lambda: court_list(court_list_values(courts.all())),
+            ),
+            'court_detail': (
+                lambda: CourtSerializer(CourtSerializer.eager_loading(
+                    Court.objects.all()).get(id=court.id)).data,
+                lambda: court_details(list(Court.objects.filter(id=court.id).values(*COURT_VALUES)))[0],
+            ),
+            'user_profile': (
+                lambda: ExtendedUserSerializer(ExtendedUserSerializer.eager_loading(
+                    ExtendedUser.objects.all()).get(id=user.id)).data,
+                lambda: user_profiles(ExtendedUser.objects.filter(id=user.id))[0],
+            ),
+        }
+
+        results = {}
+        for name, (serialized, projected) in cases.items():
+            serializer = self.run_path(serialized, JSONRenderer(), options['requests'])
+            projection = self.run_path(projected, FastJSONRenderer(), options['requests'])
+            if serializer.pop('content') != projection.pop('content'):
+                raise CommandError('The %s outputs of the two paths differ' % name)
+            results[name] = {'serializer': serializer, 'projection': projection}
+        output = json.dumps({
+            'orjson': orjson is not None,
+            'court': court.name,
+            'user': user.base_user.username,
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def run_path(self, build, renderer, requests):
+        # build the data and render it requests times; the query counts
+        # include the court and user lookups
+        latencies = []
+        queries = []
+        for _ in range(requests):
+            with CaptureQueriesContext(connection) as captured:
+                began = time.perf_counter()
+                content = renderer.render(build())
+                latencies.append(time.perf_counter() - began)
+            queries.append(len(captured))
+        result = summarize(latencies, queries, [])
+        result['bytes'] = len(content)
+        result['content'] = content
+        return result
@@ -0,0 +1,189 @@
+import random
+from math import cos, radians, sin
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.availability import booking_dates, provision_schedules
+from api.geo import KM_PER_DEGREE, grid_cell
+from api.models import Booking, Court, CourtNameGram, ExtendedUser, Log, Racket, \
+    RacketBooking, Review, Schedule, Shuttlecock, slot_mask
+from api.search import AVAILABILITY_VERSION_KEY, increment_search_version, name_grams, \
+    normalize
+
+NAME_WORDS = ['Badminton', 'Sport', 'Club', 'Arena', 'Center', 'Hall', 'Park', 'Smash',
+              'Shuttle', 'Court', 'สนาม', 'แบดมินตัน', 'กีฬา', 'ศูนย์', 'สุขุมวิท', 'ลาดพร้าว',
+              'บางนา', 'รังสิต', 'พระราม', 'สีลม']
+REVIEW_TEXTS = ['Good floor', 'Nice staff', 'Too hot', 'Great lighting', 'Hard to park',
+                'สนามดี', 'แอร์เย็น', 'ราคาถูก']
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with synthetic users, courts, reviews, schedules and bookings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--owners', type=int, default=100)
+        parser.add_argument('--courts', type=int, default=500)
+        parser.add_argument('--court-count', type=int, default=8,
+                            help='maximum number of court_numbers of a court')
+        parser.add_argument('--reviews', type=int, default=10, help='maximum reviews per court')
+        parser.add_argument('--rackets', type=int, default=4, help='rackets per court')
+        parser.add_argument('--shuttlecocks', type=int, default=2, help='shuttlecock kinds per court')
+        parser.add_argument('--bookings', type=int, default=5000)
+        parser.add_argument('--logs', type=int, default=5, help='logs per user')
+        parser.add_argument('--lat', type=float, default=13.75)
+        parser.add_argument('--long', type=float, default=100.55)
+        parser.add_argument('--radius', type=float, default=25, help='km around lat/long')
+        parser.add_argument('--prefix', default='bench', help='prefix of the generated usernames')
+        parser.add_argument('--batch-size', type=int, help='rows per INSERT, the database default if not set')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        prefix = options['prefix']
+        with transaction.atomic():
+            users = self.create_users(prefix + '_user_%d', options['users'], batch_size)
+            owners = self.create_users(prefix + '_owner_%d', options['owners'], batch_size)
+            staff = self.create_users(prefix + '_staff_%d', 1, batch_size)
+            User.objects.filter(id=staff[0].id).update(is_staff=True)
+            courts = self.create_courts(rng, owners, options, batch_size)
+            self.stdout.write('Created %d users, %d owners and %d courts'
+                              % (len(users), len(owners), len(courts)))
+
+            rackets = Racket.objects.bulk_create([
+                Racket(court=court, name='Racket %d' % i, price=rng.choice([20, 30, 50]))
+                for court in courts for i in range(options['rackets'])
+            ], batch_size=batch_size)
+            Shuttlecock.objects.bulk_create([
+                Shuttlecock(court=court, name='Shuttlecock %d' % i, count_per_unit=12,
+                            count=rng.randint(0, 200), price=rng.choice([60, 90, 120]))
+                for court in courts for i in range(options['shuttlecocks'])
+            ], batch_size=batch_size)
+            if rackets and rackets[0].id is None:
+                rackets = list(Racket.objects.filter(court__in=courts))
+            provision_schedules(courts, rackets, batch_size=batch_size)
+
+            reviews = self.create_reviews(rng, users, courts, options['reviews'], batch_size)
+            bookings = self.create_bookings(rng, users, courts, options['bookings'], batch_size)
+            Log.objects.bulk_create([
+                Log(user=user, desc='User %s has generated log %d' % (user.username, i))
+                for user in users for i in range(options['logs'])
+            ], batch_size=batch_size)
+            self.stdout.write('Created %d reviews, %d bookings and %d logs'
+                              % (reviews, bookings, len(users) * options['logs']))
+        increment_search_version()
+        increment_search_version(AVAILABILITY_VERSION_KEY)
+
+    def create_users(self, username, count, batch_size):
+        User.objects.bulk_create([User(username=username % i) for i in range(count)],
+                                 batch_size=batch_size)
+        users = list(User.objects.filter(username__in=[username % i for i in range(count)]))
+        ExtendedUser.objects.bulk_create([
+            ExtendedUser(base_user=user, credit=10 ** 9, is_verified=True) for user in users
+        ], batch_size=batch_size)
+        return users
+
+    def create_courts(self, rng, owners, options, batch_size):
+        courts = []
+        for i in range(options['courts']):
+            # uniformly spread over the disc around lat/long
+            dist = options['radius'] * rng.random() ** 0.5
+            direction = rng.random() * 6.283185307179586
+            lat = options['lat'] + dist * cos(direction) / KM_PER_DEGREE
+            long = options['long'] + dist * sin(direction) / \
+                (KM_PER_DEGREE * cos(radians(options['lat'])))
+            open = rng.choice([12, 14, 16, 18])
+            name = ('%s %s %d' % (rng.choice(NAME_WORDS), rng.choice(NAME_WORDS), i))[:30]
+            courts.append(Court(
+                owner=rng.choice(owners), is_verified=rng.random() < 0.9,
+                name=name, search_name=normalize(name),
+                desc='Synthetic court', price=rng.choice([100, 120, 150, 180, 200, 250, 300]),
+                court_count=rng.randint(1, options['court_count']),
+                open=open, close=rng.randint(open + 8, 47), lat=lat, long=long,
+                geo_cell=grid_cell(lat, long),
+            ))
+        Court.objects.bulk_create(courts, batch_size=batch_size)
+        courts = list(Court.objects.filter(owner__in=owners).order_by('id'))
+        # bulk_create skips Court.save, which indexes the names
+        CourtNameGram.objects.bulk_create([
+            CourtNameGram(court=court, gram=gram)
+            for court in courts for gram in name_grams(court.name)
+        ], batch_size=batch_size)
+        return courts
+
+    def create_reviews(self, rng, users, courts, per_court, batch_size):
+        reviews = []
+        for court in courts:
+            scores = [min(5, max(0, round(rng.gauss(3.5, 1.2))))
+                      for _ in range(rng.randint(0, min(per_court, len(users))))]
+            for user, score in zip(rng.sample(users, len(scores)), scores):
+                reviews.append(Review(user=user, court=court, score=score,
+                                      review=rng.choice(REVIEW_TEXTS)))
+            court.rating_sum = sum(scores)
+            court.rating_count = len(scores)
+        Review.objects.bulk_create(reviews, batch_size=batch_size)
+        Court.objects.bulk_update(courts, ['rating_sum', 'rating_count'], batch_size=batch_size)
+        return len(reviews)
+
+    def create_bookings(self, rng, users, courts, count, batch_size):
+        # bookings are placed in memory first fit, then the schedule masks
+        # are written once
+        dates = booking_dates()
+        schedules = {
+            (schedule.court_id, schedule.court_number, schedule.date): schedule
+            for schedule in Schedule.objects.filter(court__in=courts, date__in=dates)
+        }
+        rackets = {}
+        for racket in Racket.objects.filter(court__in=courts):
+            rackets.setdefault(racket.court_id, []).append(racket)
+        racket_schedules = {
+            (schedule.racket_id, schedule.date): schedule
+            for schedule in Schedule.objects.filter(racket__court__in=courts, date__in=dates)
+        }
+        bookings = []
+        booked_rackets = []
+        changed = {}
+        for _ in range(count):
+            court = rng.choice(courts)
+            date = rng.choice(dates)
+            length = rng.choice([2, 2, 2, 3, 4])
+            if court.close - length + 1 < court.open:
+                continue
+            start = rng.randint(court.open, court.close - length + 1)
+            end = start + length - 1
+            mask = slot_mask(start, end)
+            for court_number in range(court.court_count):
+                schedule = schedules[(court.id, court_number, date)]
+                if schedule.status & mask == 0:
+                    schedule.status |= mask
+                    changed[schedule.id] = schedule
+                    booking = Booking(user=rng.choice(users), court=court, date=date,
+                                      day_of_the_week=date.weekday(), court_number=court_number,
+                                      start=start, end=end, price=court.price * length // 2,
+                                      play_datetime=Booking.play_datetime_of(date, start))
+                    bookings.append(booking)
+                    for racket in rackets.get(court.id, []):
+                        racket_schedule = racket_schedules[(racket.id, date)]
+                        if rng.random() < 0.3 and racket_schedule.status & mask == 0:
+                            racket_schedule.status |= mask
+                            changed[racket_schedule.id] = racket_schedule
+                            booked_rackets.append((booking, racket))
+                            break
+                    break
+        last_id = Booking.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        Booking.objects.bulk_create(bookings, batch_size=batch_size)
+        if bookings and bookings[0].id is None:
+            # the backend does not return the ids; the rows were inserted in
+            # order inside this transaction
+            for booking, booking_id in zip(bookings, Booking.objects.filter(
+                    id__gt=last_id).order_by('id').values_list('id', flat=True)):
+                booking.id = booking_id
+        RacketBooking.objects.bulk_create([
+            RacketBooking(user=booking.user, racket=racket, booking=booking, price=racket.price)
+            for booking, racket in booked_rackets
+        ], batch_size=batch_size)
+        Schedule.objects.bulk_update(list(changed.values()), ['status'], batch_size=batch_size)
+        return len(bookings)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from api.availability import provision_schedules
+from api.models import Court, Racket
+
+
+class Command(BaseCommand):
+    help = 'Create the missing Schedule rows of existing courts and rackets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        created = 0
+        for model, key in ((Court, 'courts'), (Racket, 'rackets')):
+            last_id = 0
+            while True:
+                batch = list(model.objects.filter(id__gt=last_id).order_by('id')[:batch_size])
+                if not batch:
+                    break
+                created += provision_schedules(batch_size=batch_size, **{key: batch})
+                last_id = batch[-1].id
+        self.stdout.write('Created %d schedules' % created)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+
+from api.models import Court
+
+
+class Command(BaseCommand):
+    help = 'Recompute Court.rating_sum and rating_count from the reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        repaired = 0
+        last_id = 0
+        while True:
+            courts = list(Court.objects.filter(id__gt=last_id).order_by('id').annotate(
+                score_sum=Coalesce(Sum('reviews__score'), 0),
+                score_count=Count('reviews'),
+            )[:batch_size])
+            if not courts:
+                break
+            stale = [court for court in courts
+                     if (court.rating_sum, court.rating_count) != (court.score_sum, court.score_count)]
+            for court in stale:
+                court.rating_sum = court.score_sum
+                court.rating_count = court.score_count
+            Court.objects.bulk_update(stale, ['rating_sum', 'rating_count'])
+            repaired += len(stale)
+            last_id = courts[-1].id
+        self.stdout.write('Repaired %d courts' % repaired)
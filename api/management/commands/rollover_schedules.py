@@ -0,0 +1,18 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.availability import archive_schedules
+
+
+class Command(BaseCommand):
+    help = 'Archive the schedules of past days and provision the booking horizon'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        archived = archive_schedules(timezone.localdate(), batch_size=batch_size)
+        self.stdout.write('Archived %d schedules' % archived)
+        call_command('provision_schedules', batch_size=batch_size, stdout=self.stdout)
@@ -0,0 +1,103 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from api.models import Court, slot_mask
+
+
+def generate_trace(rng, days, requests, open, close, cancel_rate):
+    # ['book', day, start, end] entries with mostly short and some long
+    # bookings, and ['cancel', trace index of a book entry] entries
+    trace = []
+    booked = []
+    for _ in range(requests):
+        if booked and rng.random() < cancel_rate:
+            trace.append(['cancel', booked.pop(rng.randrange(len(booked)))])
+            continue
+        length = rng.choice([2, 2, 2, 3, 4, 4, 6, 8])
+        start = rng.randint(open, close - length + 1)
+        booked.append(len(trace))
+        trace.append(['book', rng.randrange(days), start, start + length - 1])
+    return trace
+
+
+def replay(allocate, court, days, trace):
+    # book and cancel in memory, timing only the allocator calls
+    statuses = [{court_number: 0 for court_number in range(court.court_count)}
+                for _ in range(days)]
+    # trace index of an accepted book entry: its court_number
+    owners = {}
+    accepted = 0
+    requested = 0
+    cancelled = 0
+    latencies = []
+    for index, entry in enumerate(trace):
+        if entry[0] == 'cancel':
+            # the cancellation of a rejected request is dropped
+            court_number = owners.pop(entry[1], None)
+            if court_number is not None:
+                _, day, start, end = trace[entry[1]]
+                statuses[day][court_number] &= ~slot_mask(start, end)
+                cancelled += 1
+            continue
+        _, day, start, end = entry
+        requested += 1
+        began = time.perf_counter()
+        candidates = allocate(court, statuses[day], start, end)
+        latencies.append(time.perf_counter() - began)
+        if candidates:
+            statuses[day][candidates[0]] |= slot_mask(start, end)
+            owners[index] = candidates[0]
+            accepted += 1
+    latencies.sort()
+    return {
+        'requests': requested,
+        'accepted': accepted,
+        'acceptance_rate': accepted / requested if requested else 0,
+        'cancelled': cancelled,
+        'latency_us': {
+            'mean': sum(latencies) / len(latencies) * 1e6 if latencies else 0,
+            'p50': latencies[len(latencies) // 2] * 1e6 if latencies else 0,
+            'p99': latencies[int(len(latencies) * 0.99)] * 1e6 if latencies else 0,
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = 'Replay a booking trace against court allocators and compare them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--allocators', nargs='+',
+                            default=['api.allocators.first_fit', 'api.allocators.best_fit'])
+        parser.add_argument('--trace', help='JSON file of ["book", day, start, end] and '
+                                            '["cancel", index of the book entry] entries')
+        parser.add_argument('--save-trace', help='write the generated trace to this file')
+        parser.add_argument('--court-count', type=int, default=4)
+        parser.add_argument('--open', type=int, default=16)
+        parser.add_argument('--close', type=int, default=44)
+        parser.add_argument('--days', type=int, default=7)
+        parser.add_argument('--requests', type=int, default=250)
+        parser.add_argument('--cancel-rate', type=float, default=0.1)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        court = Court(court_count=options['court_count'],
+                      open=options['open'], close=options['close'])
+        if options['trace']:
+            with open(options['trace']) as f:
+                trace = json.load(f)
+        else:
+            trace = generate_trace(random.Random(options['seed']), options['days'],
+                                   options['requests'], court.open, court.close,
+                                   options['cancel_rate'])
+        if options['save_trace']:
+            with open(options['save_trace'], 'w') as f:
+                json.dump(trace, f)
+        days = max([entry[1] + 1 for entry in trace if entry[0] == 'book'], default=0)
+        results = {}
+        for path in options['allocators']:
+            results[path] = replay(import_string(path), court, days, trace)
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,97 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:01
+
+from datetime import timedelta
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def date_schedules(apps, schema_editor):
+    # a weekly row becomes the row of the next occurrence of its day; a
+    # status left over from a past week is dropped, as Schedule.update did
+    Schedule = apps.get_model('api', 'Schedule')
+    now = timezone.localtime(timezone.now())
+    today = now.date()
+    for schedule in Schedule.objects.all():
+        dist = (now.weekday() - schedule.day_of_the_week) % 7
+        if schedule.last_update < now - timedelta(days=dist):
+            schedule.status = 0
+        schedule.date = today + timedelta(days=(schedule.day_of_the_week - today.weekday()) % 7)
+        schedule.save()
+
+
+def date_bookings(apps, schema_editor):
+    Booking = apps.get_model('api', 'Booking')
+    for booking in Booking.objects.all():
+        booked_date = timezone.localtime(booking.booked_date).date()
+        # update() leaves booked_date (auto_now) as it is
+        Booking.objects.filter(pk=booking.pk).update(
+            date=booked_date + timedelta(days=(booking.day_of_the_week - booked_date.weekday()) % 7))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_auto_20200423_2105'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='date',
+            field=models.DateField(null=True),
+        ),
+        migrations.RunPython(date_schedules, migrations.RunPython.noop),
+        migrations.RunPython(date_bookings, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='schedule',
+            name='date',
+            field=models.DateField(),
+        ),
+        migrations.AlterField(
+            model_name='booking',
+            name='date',
+            field=models.DateField(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='schedule',
+            unique_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='last_update',
+        ),
+        migrations.AddConstraint(
+            model_name='schedule',
+            constraint=models.UniqueConstraint(fields=('court', 'court_number', 'date'), name='unique_court_schedule'),
+        ),
+        migrations.AddConstraint(
+            model_name='schedule',
+            constraint=models.UniqueConstraint(fields=('racket', 'date'), name='unique_racket_schedule'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['court', 'date'], name='api_schedul_court_i_e2d981_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['date'], name='api_schedul_date_284794_idx'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedSchedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('status', models.BigIntegerField(default=0)),
+                ('court_number', models.IntegerField(blank=True, null=True)),
+                ('court', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_schedules', to='api.Court')),
+                ('racket', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_schedules', to='api.Racket')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_dated_schedules'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='court',
+            name='availability_version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
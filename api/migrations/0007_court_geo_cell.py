@@ -0,0 +1,33 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+from api.geo import grid_cell
+
+
+def fill_geo_cells(apps, schema_editor):
+    Court = apps.get_model('api', 'Court')
+    for court in Court.objects.all():
+        court.geo_cell = grid_cell(court.lat, court.long)
+        court.save(update_fields=['geo_cell'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_court_availability_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='court',
+            name='geo_cell',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_geo_cells, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='court',
+            name='geo_cell',
+            field=models.IntegerField(db_index=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:30
+
+from django.db import migrations, models
+
+
+def fill_ratings(apps, schema_editor):
+    Court = apps.get_model('api', 'Court')
+    for court in Court.objects.annotate(score_sum=models.Sum('reviews__score'),
+                                        score_count=models.Count('reviews')):
+        court.rating_sum = court.score_sum or 0
+        court.rating_count = court.score_count
+        court.save(update_fields=['rating_sum', 'rating_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_court_geo_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='court',
+            name='rating_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='court',
+            name='rating_sum',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from api.search import name_grams
+
+
+def index_court_names(apps, schema_editor):
+    Court = apps.get_model('api', 'Court')
+    CourtNameGram = apps.get_model('api', 'CourtNameGram')
+    for court in Court.objects.all():
+        CourtNameGram.objects.bulk_create([CourtNameGram(court=court, gram=gram)
+                                           for gram in name_grams(court.name)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_court_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourtNameGram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('court', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='name_grams', to='api.Court')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='courtnamegram',
+            constraint=models.UniqueConstraint(fields=('gram', 'court'), name='unique_court_name_gram'),
+        ),
+        migrations.RunPython(index_court_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_court_name_gram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='court',
+            name='version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='extendeduser',
+            name='version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='court',
+            name='name',
+            field=models.CharField(db_index=True, max_length=30),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:35
+
+from datetime import datetime, timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_play_datetimes(apps, schema_editor):
+    Booking = apps.get_model('api', 'Booking')
+    bookings = list(Booking.objects.all())
+    for booking in bookings:
+        # Booking.play_datetime_of
+        booking.play_datetime = timezone.make_aware(
+            datetime.combine(booking.date, datetime.min.time()) + timedelta(minutes=30 * booking.start))
+    Booking.objects.bulk_update(bookings, ['play_datetime'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_resource_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='play_datetime',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(set_play_datetimes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='booking',
+            name='play_datetime',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['user', 'play_datetime'], name='api_booking_user_id_0ff7ce_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.5 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+from api.search import normalize
+
+
+def set_search_names(apps, schema_editor):
+    Court = apps.get_model('api', 'Court')
+    courts = list(Court.objects.all())
+    for court in courts:
+        court.search_name = normalize(court.name)
+    Court.objects.bulk_update(courts, ['search_name'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_booking_play_datetime'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='court',
+            name='search_name',
+            field=models.CharField(default='', editable=False, max_length=90),
+        ),
+        migrations.RunPython(set_search_names, migrations.RunPython.noop),
+    ]
@@ -2,12 +2,23 @@ from datetime import datetime, timedelta
 from django.utils import timezone
 
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator, \
     MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from django.core.validators import RegexValidator
 
+from .geo import grid_cell
+from .search import bump_search_version, index_court_name, normalize
+
+
+def slot_mask(start, end):
+    # bits start..end (inclusive) of a 48-slot day
+    return ((1 << (end - start + 1)) - 1) << start
+
+
 class ExtendedUser(models.Model):
     is_verified = models.BooleanField(default=False)
     credit = models.IntegerField(default=0, blank=True, )
@@ -28,10 +39,17 @@ class ExtendedUser(models.Model):
         max_length=12,
         blank=True,
     )
+    # see api.versions
+    version = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.base_user.username
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version = F('version') + 1
+        super().save(*args, **kwargs)
+
     class Meta:
         unique_together = ('base_user',)
 
@@ -49,48 +67,72 @@ class Court(models.Model):
     close = models.IntegerField(validators=[MinValueValidator(0), ])
     lat = models.FloatField()
     long = models.FloatField()
-    name = models.CharField(max_length=30)
+    geo_cell = models.IntegerField(db_index=True, editable=False)
+    name = models.CharField(max_length=30, db_index=True)
+    # api.search.normalize of the name; casefold can lengthen it
+    search_name = models.CharField(max_length=90, default='', editable=False)
     desc = models.CharField(max_length=200, null=True)
+    # see api.versions
+    version = models.IntegerField(default=0, editable=False)
+    availability_version = models.IntegerField(default=0, editable=False)
+    # kept up to date by CourtViewSet.rate_court, see `manage.py repair_ratings`
+    rating_sum = models.IntegerField(default=0, editable=False)
+    rating_count = models.IntegerField(default=0, editable=False)
+
+    # columns only written with F() updates, which a save would undo by
+    # writing back the values read with the instance
+    update_only_fields = ('availability_version', 'rating_sum', 'rating_count')
 
     def __str__(self):
         return self.name
 
-    def rating_count(self):
-        return len(self.reviews.all())
+    def save(self, *args, **kwargs):
+        self.geo_cell = grid_cell(self.lat, self.long)
+        self.search_name = normalize(self.name)
+        if not self._state.adding:
+            self.version = F('version') + 1
+            if kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                           if not field.primary_key and
+                                           field.name not in self.update_only_fields]
+        super().save(*args, **kwargs)
+        from .availability import reconcile_schedules
+        reconcile_schedules(self)
+        index_court_name(self)
+        bump_search_version()
+
+    def clean(self):
+        from .availability import surplus_bookings
+        if self.pk is not None:
+            booked = surplus_bookings(self.pk, self.court_count)
+            if booked:
+                raise ValidationError({'court_count': 'court_number %s still has bookings'
+                                                      % ', '.join(map(str, booked))})
 
     def avg_score(self):
-        m_sum = 0
-        reviews = self.reviews.all()
-        if not reviews:
+        if not self.rating_count:
             return 0
-        for review in reviews:
-            m_sum += review.score
-        return m_sum / len(reviews)
-
-    def check_collision(self, day_of_the_week, start, end):
-        for court_number in range(0, self.court_count):
-            try:
-                schedule = self.schedules.get(day_of_the_week=day_of_the_week, court_number=court_number)
-            except:
-                schedule = Schedule.objects.create(court=self, court_number=court_number,
-                                                   day_of_the_week=day_of_the_week, )
-            print(court_number, schedule)
-            if schedule.check_collision(start, end) == 0:
-                print("pass")
-                return 0
-        return 1
-
-    def book(self, day_of_the_week, start, end):
-        if self.check_collision(day_of_the_week, start, end) != 0:
-            return 1, -1
-        for schedule in self.schedules.filter(day_of_the_week=day_of_the_week):
-            if schedule.book(start, end) == 0:
-                return 0, schedule.court_number
+        return self.rating_sum / self.rating_count
+
+    def book(self, date, start, end):
+        from .allocators import get_allocator
+        from .availability import court_statuses, invalidate_availability
+        allocate = get_allocator()
+        statuses = court_statuses([self], date)[self.id]
+        for court_number in allocate(self, statuses, start, end):
+            schedules = self.schedules.filter(date=date, court_number=court_number)
+            if Schedule.claim(schedules, start, end) == 1:
+                invalidate_availability(self.id)
+                bump_search_version(availability=True)
+                return 0, court_number
         return 1, -1
 
-    def unbooked(self, day_of_the_week, start, end, court_number):
-        schedule = self.schedules.get(day_of_the_week=day_of_the_week, court_number=court_number)
-        schedule.unbooked(start, end)
+    def unbooked(self, date, start, end, court_number):
+        Schedule.release(self.schedules.filter(date=date, court_number=court_number),
+                         start, end)
+        from .availability import invalidate_availability
+        invalidate_availability(self.id)
+        bump_search_version(availability=True)
         return 0
 
 
@@ -106,26 +148,38 @@ class Booking(models.Model):
         related_name='bookings'
     )
     booked_date = models.DateTimeField(auto_now=True)
+    date = models.DateField()
     day_of_the_week = models.IntegerField()
     court_number = models.IntegerField()
     start = models.IntegerField()
     end = models.IntegerField()
     price = models.IntegerField(validators=[MinValueValidator(0), ])
+    # when the booking starts, set by save; bookings are active until then
+    play_datetime = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'play_datetime']),
+        ]
+
+    @staticmethod
+    def play_datetime_of(date, start):
+        # start is the half hour slot of date, in local time
+        return timezone.make_aware(datetime.combine(date, datetime.min.time()) +
+                                   timedelta(minutes=30 * start))
+
+    def save(self, *args, **kwargs):
+        if self.play_datetime is None:
+            self.play_datetime = Booking.play_datetime_of(self.date, self.start)
+        super().save(*args, **kwargs)
+
+    @property
+    def days_left(self):
+        return (self.date - timezone.localdate()).days
 
     @property
     def is_active(self):
-        day0 = self.booked_date.replace(hour=0, minute=0, second=0)
-        dist = self.day_of_the_week - day0.weekday()
-        if dist < 0:
-            dist += 7
-        # dist += 1
-        cut_off_day = day0 + timedelta(days=dist)
-        lc = timezone.localtime(timezone.now())
-        if ( lc < cut_off_day ): 
-            return True
-        elif ( lc.date() == cut_off_day.date() and (lc.hour*2)+(lc.minute >= 30) < self.start ):
-            return True
-        return False
+        return timezone.now() < self.play_datetime
 
 
 class Racket(models.Model):
@@ -137,27 +191,23 @@ class Racket(models.Model):
         on_delete=models.CASCADE,
     )
 
-    def check_collision(self, day_of_the_week, start, end):
-        try:
-            schedule = self.schedules.get(day_of_the_week=day_of_the_week)
-        except:
-            schedule = Schedule.objects.create(racket=self,
-                                               day_of_the_week=day_of_the_week)
-        if schedule.check_collision(start, end) == 0:
-            return 0
-        return 1
-
-    def book(self, day_of_the_week, start, end):
-        if self.check_collision(day_of_the_week, start, end) != 0:
-            return 1
-        schedule = self.schedules.get(day_of_the_week=day_of_the_week)
-        if schedule.book(start, end) == 0:
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            from .availability import provision_schedules
+            provision_schedules(rackets=[self])
+        bump_search_version()
+
+    def book(self, date, start, end):
+        if Schedule.claim(self.schedules.filter(date=date), start, end) == 1:
+            bump_search_version(availability=True)
             return 0
         return 1
 
-    def unbooked(self, day_of_the_week, start, end):
-        schedule = self.schedules.get(day_of_the_week=day_of_the_week)
-        schedule.unbooked(start, end)
+    def unbooked(self, date, start, end):
+        Schedule.release(self.schedules.filter(date=date), start, end)
+        bump_search_version(availability=True)
         return 0
 
     def __str__(self):
@@ -190,52 +240,71 @@ class Schedule(models.Model):
         Saturday = 5,
         Sunday = 6
 
+    date = models.DateField()
     day_of_the_week = models.IntegerField(choices=Day.choices)
     status = models.BigIntegerField(default=0)
-    last_update = models.DateTimeField(auto_now_add=True)
     court_number = models.IntegerField(blank=True, null=True)
 
-    def update(self):
-        dist = timezone.localtime(timezone.now()).weekday() \
-               - self.day_of_the_week
-        if dist < 0:
-            dist += 7
-        cut_off_day = timezone.localtime(timezone.now()) \
-                      - timedelta(days=dist)
-        cut_off_day.replace(hour=0, minute=0, second=0)
-        if self.last_update < cut_off_day:
-            self.status = 0
-        self.last_update = timezone.localtime(timezone.now())
-
-    def check_collision(self, start, end):
-        self.update()
-        for i in range(start, end + 1):
-            if ((1 << i) & self.status) != 0:
-                return 1
-        return 0
+    def save(self, *args, **kwargs):
+        self.day_of_the_week = self.date.weekday()
+        super().save(*args, **kwargs)
 
-    def book(self, start, end):
-        if self.check_collision(start, end) != 0:
-            return 1
-        for i in range(start, end + 1):
-            self.status |= 1 << i
-        self.save()
-        return 0
+    @staticmethod
+    def claim(schedules, start, end):
+        # compare-and-set in one UPDATE: the slot bits are only set on rows
+        # where none of them is taken, so the row count says who won
+        mask = slot_mask(start, end)
+        return schedules.annotate(
+            collision=F('status').bitand(mask),
+        ).filter(collision=0).update(status=F('status').bitor(mask))
 
-    def unbooked(self, start, end):
-        for i in range(start, end + 1):
-            self.status &= ~(1 << i)
-        self.save()
-        return 0
+    @staticmethod
+    def release(schedules, start, end):
+        return schedules.update(status=F('status').bitand(~slot_mask(start, end)))
 
     def __str__(self):
         if self.court is None:
-            return "%s of racket %s" % (self.day_of_the_week, self.racket.name)
+            return "%s of racket %s" % (self.date, self.racket.name)
         return "%s of court %s in %s" % \
-               (self.day_of_the_week, self.court_number, self.court)
+               (self.date, self.court_number, self.court)
 
     class Meta:
-        unique_together = (('court', 'court_number', 'day_of_the_week', 'racket', ),)
+        constraints = [
+            models.UniqueConstraint(fields=['court', 'court_number', 'date'],
+                                    name='unique_court_schedule'),
+            models.UniqueConstraint(fields=['racket', 'date'],
+                                    name='unique_racket_schedule'),
+        ]
+        indexes = [
+            models.Index(fields=['court', 'date']),
+            models.Index(fields=['date']),
+        ]
+
+
+class ArchivedSchedule(models.Model):
+    court = models.ForeignKey(
+        Court,
+        on_delete=models.CASCADE,
+        related_name='archived_schedules',
+        blank=True,
+        null=True,
+    )
+    racket = models.ForeignKey(
+        Racket,
+        on_delete=models.CASCADE,
+        related_name='archived_schedules',
+        blank=True,
+        null=True,
+    )
+    date = models.DateField(db_index=True)
+    status = models.BigIntegerField(default=0)
+    court_number = models.IntegerField(blank=True, null=True)
+
+    def __str__(self):
+        if self.court is None:
+            return "%s of racket %s" % (self.date, self.racket.name)
+        return "%s of court %s in %s" % \
+               (self.date, self.court_number, self.court)
 
 
 class Review(models.Model):
@@ -257,6 +326,10 @@ class Review(models.Model):
     class Meta:
         unique_together = ('user', 'court')
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_search_version()
+
     def __str__(self):
         return "%s review %s" % (self.user, self.court,)
 
@@ -272,6 +345,10 @@ class Shuttlecock(models.Model):
         on_delete=models.CASCADE,
     )
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_search_version()
+
     def __str__(self):
         return self.name
 
@@ -323,6 +400,22 @@ class Document(models.Model):
         return '%s' % (self.user.username,)
 
 
+class CourtNameGram(models.Model):
+    # name search index, kept up to date by Court.save
+    court = models.ForeignKey(
+        Court,
+        related_name='name_grams',
+        on_delete=models.CASCADE,
+    )
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gram', 'court'],
+                                    name='unique_court_name_gram'),
+        ]
+
+
 class Image(models.Model):
     url = models.URLField()
     court = models.ForeignKey(
@@ -375,4 +468,3 @@ class ShuttlecockBooking(models.Model):
     reserve_date = models.DateTimeField(auto_now=True)
     price = models.IntegerField(validators=[MinValueValidator(0), ])
     count = models.IntegerField(validators=[MinValueValidator(0), ],null=True)
-
@@ -0,0 +1,123 @@
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+
+
+class KeysetPagination(CursorPagination):
+    # Cursor pagination over the ordering of the queryset, which must end in
+    # a unique column (normally id). The cursor keeps the values of every
+    # ordering column of the last row, so a page starts right after that row
+    # whatever was inserted in between, without OFFSET.
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('id',)
+
+    def get_ordering(self, request, queryset, view):
+        if queryset.query.order_by:
+            return tuple(queryset.query.order_by)
+        return self.ordering
+
+    def _get_position_from_instance(self, instance, ordering):
+        # instance is a model or a values() row
+        if isinstance(instance, dict):
+            values = [instance[field.lstrip('-')] for field in ordering]
+        else:
+            values = [getattr(instance, field.lstrip('-')) for field in ordering]
+        return json.dumps(values, cls=DjangoJSONEncoder)
+
+    def ordering_field(self, queryset, name):
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        return queryset.model._meta.get_field(name)
+
+    def position_values(self, queryset, position):
+        # the values of position converted by their ordering columns; a
+        # cursor of another ordering does not convert
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        result = []
+        for order, value in zip(self.ordering, values):
+            try:
+                value = self.ordering_field(queryset, order.lstrip('-')).to_python(value)
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+            if value is None:
+                raise NotFound(self.invalid_cursor_message)
+            result.append(value)
+        return result
+
+    def keyset_filter(self, queryset, position, reverse):
+        # rows after position in the ordering, or before it when reverse
+        values = self.position_values(queryset, position)
+        query = Q()
+        equal = Q()
+        for order, value in zip(self.ordering, values):
+            field = order.lstrip('-')
+            lookup = '__lt' if reverse != order.startswith('-') else '__gt'
+            query |= equal & Q(**{field + lookup: value})
+            equal &= Q(**{field: value})
+        return query
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        if reverse:
+            queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(self.keyset_filter(queryset, current_position, self.cursor.reverse))
+
+        # one extra row tells whether there is a following page
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = list(results[:self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
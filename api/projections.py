@@ -0,0 +1,185 @@
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import Booking, Court, Document, Image, RacketBooking, Review, ShuttlecockBooking
+
+# Plain dict versions of the serializer output of the hottest GETs, built
+# from values() rows. Every function returns exactly what its serializer
+# would, key order included, so the two paths are interchangeable; see
+# `manage.py benchmark_serializers`.
+
+datetime_field = serializers.DateTimeField()
+
+COURT_LIST_VALUES = ('id', 'name', 'price', 'rating_count', 'rating_sum')
+COURT_VALUES = ('id', 'name', 'price', 'owner__username', 'owner__first_name',
+                'owner__last_name', 'desc', 'rating_sum', 'rating_count', 'court_count',
+                'is_verified', 'lat', 'long', 'open', 'close')
+BOOKING_VALUES = ('id', 'day_of_the_week', 'court_id', 'court_number', 'play_datetime',
+                  'price', 'start', 'end')
+
+
+def sparse(data, fields):
+    # data without the keys that are not in fields, as SparseFieldsMixin
+    if not fields:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def avg_score(rating_sum, rating_count):
+    # Court.avg_score
+    if not rating_count:
+        return 0
+    return rating_sum / rating_count
+
+
+def court_list_values(queryset):
+    # the values() of the CourtViewSet.list queryset that court_list needs,
+    # with its ordering annotations for the pagination
+    annotations = [name for name in ('distance', 'rating', 'first_image')
+                   if name in queryset.query.annotations]
+    return queryset.values(*COURT_LIST_VALUES, *annotations)
+
+
+def court_list(rows):
+    # CourtListSerializer
+    return [
+        {
+            'id': row['id'],
+            'name': row['name'],
+            'price': row['price'],
+            'rating_count': row['rating_count'],
+            'avg_score': avg_score(row['rating_sum'], row['rating_count']),
+            'distance': None if row.get('distance') is None else round(row['distance'], 3),
+            'image': row.get('first_image'),
+        }
+        for row in rows
+    ]
+
+
+def court_details(rows):
+    # CourtSerializer of the COURT_VALUES rows, reviews and images in one
+    # query each
+    court_ids = [row['id'] for row in rows]
+    reviews = {}
+    for review in Review.objects.filter(court_id__in=court_ids).values('court_id', 'review', 'score'):
+        reviews.setdefault(review['court_id'], []).append(
+            {'review': review['review'], 'score': review['score']})
+    images = {}
+    for image in Image.objects.filter(court_id__in=court_ids).values('court_id', 'url', 'timestamp'):
+        images.setdefault(image['court_id'], []).append(
+            {'url': image['url'], 'timestamp': datetime_field.to_representation(image['timestamp'])})
+    return [
+        {
+            'id': row['id'],
+            'name': row['name'],
+            'price': row['price'],
+            'owner': {
+                'username': row['owner__username'],
+                'first_name': row['owner__first_name'],
+                'last_name': row['owner__last_name'],
+            },
+            'desc': row['desc'],
+            'rating_count': row['rating_count'],
+            'avg_score': avg_score(row['rating_sum'], row['rating_count']),
+            'reviews': reviews.get(row['id'], []),
+            'images': images.get(row['id'], []),
+            'court_count': row['court_count'],
+            'is_verified': row['is_verified'],
+            'lat': row['lat'],
+            'long': row['long'],
+            'open': row['open'],
+            'close': row['close'],
+        }
+        for row in rows
+    ]
+
+
+def booking_list(rows):
+    # BookingSerializer of the BOOKING_VALUES rows
+    booking_ids = [row['id'] for row in rows]
+    courts = {court['id']: court for court in court_details(list(
+        Court.objects.filter(id__in={row['court_id'] for row in rows}).values(*COURT_VALUES)))}
+    rackets = {}
+    for racket in RacketBooking.objects.filter(booking_id__in=booking_ids).values(
+            'booking_id', 'id', 'racket__name', 'price'):
+        rackets.setdefault(racket['booking_id'], []).append(
+            {'id': racket['id'], 'name': racket['racket__name'], 'price': racket['price']})
+    shuttlecocks = {}
+    for shuttlecock in ShuttlecockBooking.objects.filter(booking_id__in=booking_ids).values(
+            'booking_id', 'id', 'shuttlecock__name', 'price', 'count', 'shuttlecock__count_per_unit'):
+        shuttlecocks.setdefault(shuttlecock['booking_id'], []).append({
+            'id': shuttlecock['id'],
+            'name': shuttlecock['shuttlecock__name'],
+            'price': shuttlecock['price'],
+            'count': shuttlecock['count'],
+            'count_per_unit': str(shuttlecock['shuttlecock__count_per_unit']),
+        })
+    now = timezone.now()
+    return [
+        {
+            'id': row['id'],
+            'day_of_the_week': row['day_of_the_week'],
+            'court': courts[row['court_id']],
+            'court_number': row['court_number'],
+            'is_active': now < row['play_datetime'],
+            'price': row['price'],
+            'start': row['start'],
+            'end': row['end'],
+            'racket_bookings': rackets.get(row['id'], []),
+            'shuttlecock_bookings': shuttlecocks.get(row['id'], []),
+        }
+        for row in rows
+    ]
+
+
+def bookings(user_ids):
+    # {user id: BookingSerializer of the bookings of the user}
+    rows = list(Booking.objects.filter(user_id__in=user_ids).values('user_id', *BOOKING_VALUES))
+    result = {}
+    for row, booking in zip(rows, booking_list(rows)):
+        result.setdefault(row['user_id'], []).append(booking)
+    return result
+
+
+def user_profiles(queryset):
+    # ExtendedUserSerializer of the ExtendedUser queryset
+    rows = list(queryset.values(
+        'id', 'base_user_id', 'base_user__username', 'base_user__first_name',
+        'base_user__last_name', 'base_user__email', 'is_verified', 'phone_number', 'credit',
+        'base_user__is_staff'))
+    user_ids = [row['base_user_id'] for row in rows]
+    ban_lists = {}
+    for user in User.objects.filter(banned__in=[row['id'] for row in rows]).values(
+            'banned', 'username', 'first_name', 'last_name'):
+        ban_lists.setdefault(user['banned'], []).append({
+            'username': user['username'],
+            'first_name': user['first_name'],
+            'last_name': user['last_name'],
+        })
+    reviews = {}
+    for review in Review.objects.filter(user_id__in=user_ids).values('user_id', 'review', 'score'):
+        reviews.setdefault(review['user_id'], []).append(
+            {'review': review['review'], 'score': review['score']})
+    documents = {}
+    for document in Document.objects.filter(user_id__in=user_ids).values('user_id', 'timestamp'):
+        documents.setdefault(document['user_id'], []).append(
+            {'timestamp': datetime_field.to_representation(document['timestamp'])})
+    user_bookings = bookings(user_ids)
+    return [
+        {
+            'username': row['base_user__username'],
+            'first_name': row['base_user__first_name'],
+            'last_name': row['base_user__last_name'],
+            'email': row['base_user__email'],
+            'ban_list': ban_lists.get(row['id'], []),
+            'is_verified': row['is_verified'],
+            'phone_number': row['phone_number'],
+            'credit': row['credit'],
+            'is_staff': row['base_user__is_staff'],
+            'reviews': reviews.get(row['base_user_id'], []),
+            'documents': documents.get(row['base_user_id'], []),
+            'bookings': user_bookings.get(row['base_user_id'], []),
+        }
+        for row in rows
+    ]
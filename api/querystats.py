@@ -0,0 +1,103 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('api.queries')
+
+
+def query_budget(queries):
+    # declare the most SQL queries a view method may run per request; going
+    # over is logged by QueryStatsMiddleware and fails api.testing helpers
+    def decorator(function):
+        function.query_budget = queries
+        return function
+    return decorator
+
+
+def view_budget(view_func, method):
+    # the query_budget of the ViewSet method handling method, if declared
+    actions = getattr(view_func, 'actions', None) or {}
+    cls = getattr(view_func, 'cls', None)
+    handler = getattr(cls, actions.get(method.lower(), ''), None)
+    return getattr(handler, 'query_budget', None)
+
+
+class QueryStats:
+    # collects the statements run through the wrapped connections
+
+    def __init__(self, slowest):
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []
+        self.keep = slowest
+
+    def __call__(self, execute, sql, params, many, context):
+        began = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - began
+            self.count += 1
+            self.time += elapsed
+            if self.keep:
+                self.slowest.append((elapsed, sql))
+                self.slowest.sort(key=lambda statement: statement[0], reverse=True)
+                del self.slowest[self.keep:]
+
+    def as_dict(self):
+        return {
+            'queries': self.count,
+            'db_ms': round(self.time * 1e3, 3),
+            'slowest': [[round(elapsed * 1e3, 3), sql[:settings.QUERY_STATS_SQL_LENGTH]]
+                        for elapsed, sql in self.slowest],
+        }
+
+
+class QueryStatsMiddleware:
+    # Counts the SQL queries and database time of every request, writes them
+    # as one JSON line to the api.queries logger and attaches them to the
+    # response as response.query_stats. Staff get them in X-Query-* headers
+    # by sending X-Query-Stats: 1.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats(settings.QUERY_STATS_SLOWEST)
+        request.query_budget = None
+        began = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - began
+
+        result = stats.as_dict()
+        result['budget'] = request.query_budget
+        result['over_budget'] = request.query_budget is not None and \
+            stats.count > request.query_budget
+        response.query_stats = result
+
+        user = getattr(request, 'user', None)
+        line = json.dumps(dict(result, method=request.method, path=request.path,
+                               status=response.status_code, ms=round(elapsed * 1e3, 3),
+                               user=getattr(user, 'id', None)))
+        if result['over_budget']:
+            logger.warning(line)
+        else:
+            logger.info(line)
+
+        if request.META.get('HTTP_X_QUERY_STATS') and user is not None and user.is_staff:
+            response['X-Query-Count'] = str(stats.count)
+            response['X-Query-Time-Ms'] = str(result['db_ms'])
+            response['X-Query-Slowest'] = json.dumps(result['slowest'])
+            if request.query_budget is not None:
+                response['X-Query-Budget'] = str(request.query_budget)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = view_budget(view_func, request.method)
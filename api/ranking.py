@@ -0,0 +1,36 @@
+import heapq
+
+# A recommendation score is the weighted sum of parts that each lie in 0..1.
+WEIGHTS = {
+    'distance': 0.35,
+    'rating': 0.3,
+    'price': 0.15,
+    'availability': 0.2,
+}
+# ratings are pulled towards RATING_PRIOR as if the court had
+# RATING_PRIOR_COUNT more reviews, so one 5 does not beat many 4.5s
+RATING_PRIOR = 3.0
+RATING_PRIOR_COUNT = 5
+# the price at which the price part is 0.5
+PRICE_SCALE = 200
+
+
+def court_score(distance, max_dist, rating_sum, rating_count, price, free_fraction):
+    closeness = 1 - min(distance / max_dist, 1) if max_dist > 0 else 1
+    rating = (rating_sum + RATING_PRIOR * RATING_PRIOR_COUNT) / \
+             (rating_count + RATING_PRIOR_COUNT) / 5
+    cheapness = PRICE_SCALE / (PRICE_SCALE + max(price, 0))
+    return WEIGHTS['distance'] * closeness + WEIGHTS['rating'] * rating + \
+        WEIGHTS['price'] * cheapness + WEIGHTS['availability'] * free_fraction
+
+
+def top_courts(candidates, k, max_dist):
+    # the k best (score, court id) of the (id, distance, rating_sum,
+    # rating_count, price, court_count, free courts or None) candidates,
+    # best first; only k of them are held at a time
+    scored = (
+        (court_score(distance, max_dist, rating_sum, rating_count, price,
+                     1 if free is None else free / max(court_count, 1)), -court_id)
+        for court_id, distance, rating_sum, rating_count, price, court_count, free in candidates
+    )
+    return [(score, -court_id) for score, court_id in heapq.nlargest(k, scored)]
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count
+
+GRAM_SIZE = 3
+SUGGEST_LIMIT = 10
+
+
+def normalize(text):
+    # NFC keeps Thai vowels and tone marks composed the same way whatever
+    # the keyboard sent; casefold only affects Latin letters
+    return ' '.join(unicodedata.normalize('NFC', text).casefold().split())
+
+
+def trigrams(text):
+    return {text[i:i + GRAM_SIZE] for i in range(0, len(text) - GRAM_SIZE + 1)}
+
+
+def name_grams(name):
+    # the trigrams of the name, plus '^'-marked prefixes shorter than a
+    # trigram of the name and of each of its words for one or two letter
+    # queries (Thai names often have no spaces, the whole name still counts)
+    name = normalize(name)
+    grams = trigrams(name)
+    for word in set([name] + name.split(' ')):
+        for length in range(1, GRAM_SIZE):
+            if len(word) >= length:
+                grams.add('^' + word[:length])
+    return grams
+
+
+def index_court_name(court):
+    # bring the CourtNameGram rows of court in line with its name
+    from .models import CourtNameGram
+    grams = name_grams(court.name)
+    existing = set(court.name_grams.values_list('gram', flat=True))
+    if existing - grams:
+        court.name_grams.filter(gram__in=existing - grams).delete()
+    CourtNameGram.objects.bulk_create([CourtNameGram(court=court, gram=gram)
+                                       for gram in grams - existing])
+
+
+def gram_matches(grams):
+    # ids of the courts having every gram
+    from .models import CourtNameGram
+    return CourtNameGram.objects.filter(gram__in=grams).values('court').annotate(
+        matched=Count('gram'),
+    ).filter(matched=len(grams)).values('court')
+
+
+def filter_name(queryset, q):
+    # courts of queryset whose normalized name contains q, through the gram
+    # index when q is long enough to have trigrams
+    q = normalize(q)
+    if len(q) < GRAM_SIZE:
+        return queryset.filter(search_name__contains=q)
+    queryset = queryset.filter(id__in=gram_matches(trigrams(q)))
+    if len(q) > GRAM_SIZE:
+        # every trigram matching does not mean they are in order
+        queryset = queryset.filter(search_name__contains=q)
+    return queryset
+
+
+def suggest_courts(queryset, q, limit=SUGGEST_LIMIT):
+    # first courts of queryset by name whose name contains q, or has a word
+    # starting with q when q is shorter than a trigram
+    q = normalize(q)
+    if q == '':
+        return queryset.none()
+    if len(q) < GRAM_SIZE:
+        queryset = queryset.filter(id__in=gram_matches({'^' + q}))
+    else:
+        queryset = filter_name(queryset, q)
+    return queryset.order_by('name', 'id')[:limit]
+
+
+# Court search results are cached as the ids of the matching courts, under
+# a key holding the search versions. Court, racket, shuttlecock and review
+# changes bump the search version once committed, which orphans every
+# cached result. Bookings and cancellations bump the availability version
+# instead, which only the searches filtering on free courts or rackets have
+# in their key.
+SEARCH_VERSION_KEY = 'court_search_version'
+AVAILABILITY_VERSION_KEY = 'court_search_availability_version'
+
+flights = {}
+flights_lock = threading.Lock()
+
+
+def search_version(key=SEARCH_VERSION_KEY):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def increment_search_version(key=SEARCH_VERSION_KEY):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def bump_search_version(availability=False):
+    # a search between the change and the commit would cache the old result
+    # under the new version
+    key = AVAILABILITY_VERSION_KEY if availability else SEARCH_VERSION_KEY
+    transaction.on_commit(lambda: increment_search_version(key))
+
+
+def search_key(params, availability=False):
+    versions = [search_version()]
+    if availability:
+        versions.append(search_version(AVAILABILITY_VERSION_KEY))
+    params = json.dumps(params, cls=DjangoJSONEncoder)
+    return 'court_search:%s:%s' % ('.'.join(map(str, versions)),
+                                   hashlib.md5(params.encode()).hexdigest())
+
+
+def cached_court_ids(params, queryset, availability=False):
+    # ids of the courts of queryset, shared by every search with the same
+    # params, or None when there are too many to be worth caching;
+    # availability tells whether queryset filters on free courts or rackets
+    key = search_key(params, availability)
+    ids = cache.get(key)
+    if ids is None:
+        # identical searches wait for the first one instead of running too
+        with flights_lock:
+            flight = flights.setdefault(key, threading.Lock())
+        with flight:
+            ids = cache.get(key)
+            if ids is None:
+                ids = compute_court_ids(key, queryset)
+        with flights_lock:
+            flights.pop(key, None)
+    if ids is False:
+        return None
+    return ids
+
+
+def compute_court_ids(key, queryset):
+    # other processes running the same search wait for a while on the lock
+    # key, then give up and run it themselves
+    locked = cache.add(key + ':lock', 1, settings.SEARCH_CACHE_LOCK_TIMEOUT)
+    if not locked:
+        deadline = time.monotonic() + settings.SEARCH_CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            ids = cache.get(key)
+            if ids is not None:
+                return ids
+    try:
+        ids = list(queryset.values_list('id', flat=True)[:settings.SEARCH_CACHE_MAX_IDS + 1])
+        if len(ids) > settings.SEARCH_CACHE_MAX_IDS:
+            ids = False
+        cache.set(key, ids, settings.SEARCH_CACHE_TIMEOUT)
+    finally:
+        # a waiter that gave up must not release the lock of its owner
+        if locked:
+            cache.delete(key + ':lock')
+    return ids
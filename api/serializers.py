@@ -1,5 +1,31 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from .models import *
+from .availability import surplus_bookings
+
+
+def query_param_set(request, name):
+    # the comma separated values of a query param
+    if request is None:
+        return set()
+    return {value for value in request.query_params.get(name, '').split(',') if value}
+
+
+class SparseFieldsMixin:
+    # ?fields=a,b keeps only those fields and ?expand=x,y adds the nested
+    # fields listed in Meta.expandable_fields
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        expand = query_param_set(request, 'expand')
+        for name, (serializer_class, options) in getattr(self.Meta, 'expandable_fields', {}).items():
+            if name in expand:
+                self.fields[name] = serializer_class(**options)
+        fields = query_param_set(request, 'fields')
+        if fields:
+            for name in set(self.fields) - fields - expand:
+                self.fields.pop(name)
 
 
 class ReviewSerializer(serializers.ModelSerializer):
@@ -27,6 +53,10 @@ class UserLogSerializer(serializers.ModelSerializer):
         model = User
         fields = ('username', 'logs',)
 
+    @staticmethod
+    def eager_loading(queryset):
+        return queryset.prefetch_related('logs')
+
 
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -63,7 +93,7 @@ class ImageSerializer(serializers.ModelSerializer):
         fields = ('url', 'timestamp')
 
 
-class CourtSerializer(serializers.ModelSerializer):
+class CourtSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     owner = UserSerializer(many=False)
     images = ImageSerializer(many=True)
     reviews = ReviewSerializer(many=True)
@@ -73,6 +103,45 @@ class CourtSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'price', 'owner', 'desc',
                   'rating_count', 'avg_score', 'reviews', 'images', 'court_count', 'is_verified', 'lat', 'long', 'open', 'close')
 
+    @staticmethod
+    def eager_loading(queryset):
+        return queryset.select_related('owner').prefetch_related('images', 'reviews')
+
+    def validate_court_count(self, value):
+        if self.instance is not None:
+            booked = surplus_bookings(self.instance.pk, value)
+            if booked:
+                raise serializers.ValidationError('court_number %s still has bookings'
+                                                  % ', '.join(map(str, booked)))
+        return value
+
+
+class CourtListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    # what a search result needs; the nested data is left to ?expand= or
+    # to the detail view
+    distance = serializers.SerializerMethodField()
+    image = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Court
+        fields = ('id', 'name', 'price', 'rating_count', 'avg_score', 'distance', 'image')
+        expandable_fields = {
+            'owner': (UserSerializer, {}),
+            'reviews': (ReviewSerializer, {'many': True}),
+            'images': (ImageSerializer, {'many': True}),
+        }
+
+    def get_distance(self, court):
+        # km, set when the search was by distance
+        distance = getattr(court, 'distance', None)
+        if distance is None:
+            return None
+        return round(distance, 3)
+
+    def get_image(self, court):
+        # url of the first image, annotated by CourtViewSet.list
+        return getattr(court, 'first_image', None)
+
 
 class BookingSerializer(serializers.ModelSerializer):
     court = CourtSerializer(many=False)
@@ -83,6 +152,15 @@ class BookingSerializer(serializers.ModelSerializer):
         fields = ('id', 'day_of_the_week', 'court', 'court_number', 'is_active', 'price',
                   'start', 'end', 'racket_bookings', 'shuttlecock_bookings')
 
+    @staticmethod
+    def eager_loading(queryset):
+        return queryset.prefetch_related(
+            Prefetch('court', queryset=CourtSerializer.eager_loading(Court.objects.all())),
+            Prefetch('racket_bookings', queryset=RacketBooking.objects.select_related('racket')),
+            Prefetch('shuttlecock_bookings',
+                     queryset=ShuttlecockBooking.objects.select_related('shuttlecock')),
+        )
+
 
 class RacketSerializer(serializers.ModelSerializer):
     class Meta:
@@ -130,6 +208,17 @@ class ExtendedUserSerializer(serializers.HyperlinkedModelSerializer):
                   'phone_number', 'credit', 'is_staff',
                   'reviews', 'documents', 'bookings',)
 
+    @staticmethod
+    def eager_loading(queryset):
+        # a constant number of queries for any number of users and bookings
+        return queryset.select_related('base_user').prefetch_related(
+            'ban_list',
+            'base_user__reviews',
+            'base_user__documents',
+            Prefetch('base_user__bookings',
+                     queryset=BookingSerializer.eager_loading(Booking.objects.all())),
+        )
+
 
 class UserDocumentSerializer(serializers.ModelSerializer):
     documents = DocumentSerializer(many=True)
@@ -137,3 +226,7 @@ class UserDocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('username', 'documents')
+
+    @staticmethod
+    def eager_loading(queryset):
+        return queryset.prefetch_related('documents')
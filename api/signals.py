@@ -0,0 +1,139 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .bans import forget_banned_by
+from .models import Booking, Court, Document, ExtendedUser, Image, Racket, RacketBooking, \
+    Review, Shuttlecock, ShuttlecockBooking
+from .versions import bump_booker_versions, bump_court_versions, bump_user_versions
+
+
+@receiver(m2m_changed, sender=ExtendedUser.ban_list.through)
+def ban_list_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # drop the cached banned_by sets of the users added to or removed from
+    # a ban list; instance is the banned User when reverse
+    if action == 'pre_clear' and not reverse:
+        # the ban list is already empty by post_clear
+        instance.cleared_ban_list = list(instance.ban_list.values_list('id', flat=True))
+    elif action == 'post_clear':
+        user_ids = [instance.pk] if reverse else instance.cleared_ban_list
+    elif action in ('post_add', 'post_remove'):
+        user_ids = [instance.pk] if reverse else list(pk_set)
+    else:
+        return
+    if action != 'pre_clear':
+        transaction.on_commit(lambda: forget_banned_by(user_ids))
+
+
+@receiver(m2m_changed, sender=ExtendedUser.ban_list.through)
+def ban_list_version(sender, instance, action, reverse, pk_set, **kwargs):
+    # the ban list is part of the profile of its owner; instance is the
+    # banned User and pk_set holds ExtendedUser ids when reverse
+    if not reverse:
+        owner_ids = [instance.pk]
+    elif action == 'pre_clear':
+        instance.cleared_banned = list(ExtendedUser.objects.filter(
+            ban_list=instance).values_list('id', flat=True))
+        return
+    elif action == 'post_clear':
+        owner_ids = instance.cleared_banned
+    else:
+        owner_ids = pk_set
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        ExtendedUser.objects.filter(id__in=owner_ids).update(version=F('version') + 1)
+
+
+@receiver(post_save, sender=Court)
+def court_saved(sender, instance, created, **kwargs):
+    # Court.save bumps the court itself
+    if not created:
+        bump_booker_versions([instance.id])
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def court_part_changed(sender, instance, **kwargs):
+    bump_court_versions([instance.court_id])
+
+
+# the fields of these models that show in court details or user profiles;
+# saves that leave them as loaded (credits, stock counts, last_login) bump
+# nothing
+SHOWN_FIELDS = {
+    User: ('username', 'first_name', 'last_name'),
+    Racket: ('name',),
+    Shuttlecock: ('name', 'count_per_unit'),
+}
+
+
+def shown_values(sender, instance):
+    # deferred fields are left unloaded
+    return tuple(instance.__dict__.get(field) for field in SHOWN_FIELDS[sender])
+
+
+@receiver(post_init, sender=User)
+@receiver(post_init, sender=Racket)
+@receiver(post_init, sender=Shuttlecock)
+def remember_shown_values(sender, instance, **kwargs):
+    instance.shown_values = shown_values(sender, instance)
+
+
+def shown_values_changed(sender, instance):
+    values = shown_values(sender, instance)
+    changed = values != instance.shown_values
+    instance.shown_values = values
+    return changed
+
+
+@receiver(post_save, sender=Racket)
+def racket_saved(sender, instance, created, **kwargs):
+    # the racket name shows in the racket bookings of the profiles
+    if not created and shown_values_changed(sender, instance):
+        bump_user_versions(instance.racket_bookings.values('user_id'))
+
+
+@receiver(post_save, sender=Shuttlecock)
+def shuttlecock_saved(sender, instance, created, **kwargs):
+    if not created and shown_values_changed(sender, instance):
+        bump_user_versions(instance.shuttlecock_bookings.values('user_id'))
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def review_changed(sender, instance, **kwargs):
+    bump_court_versions([instance.court_id])
+    bump_user_versions([instance.user_id])
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    # CourtViewSet.rate_court keeps the rating aggregates of the reviews it
+    # writes; reviews go away through the admin and the user cascade
+    Court.objects.filter(pk=instance.court_id).update(
+        rating_sum=F('rating_sum') - instance.score,
+        rating_count=F('rating_count') - 1)
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+@receiver(post_save, sender=RacketBooking)
+@receiver(post_delete, sender=RacketBooking)
+@receiver(post_save, sender=ShuttlecockBooking)
+@receiver(post_delete, sender=ShuttlecockBooking)
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+def user_part_changed(sender, instance, **kwargs):
+    bump_user_versions([instance.user_id])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    # the names show in the profile, in the courts of the user and in the
+    # ban lists that have the user
+    if created or not shown_values_changed(sender, instance):
+        return
+    bump_user_versions([instance.id])
+    ExtendedUser.objects.filter(ban_list=instance).update(version=F('version') + 1)
+    bump_court_versions(list(instance.courts.values_list('id', flat=True)))
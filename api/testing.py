@@ -0,0 +1,26 @@
+# Helpers for tests that guard the number of SQL queries of an endpoint,
+# based on the response.query_stats set by QueryStatsMiddleware.
+
+
+def query_stats(response):
+    stats = getattr(response, 'query_stats', None)
+    if stats is None:
+        raise AssertionError('The response has no query stats, is '
+                             'api.querystats.QueryStatsMiddleware installed?')
+    return stats
+
+
+def assert_query_budget(response, budget=None):
+    # fail when the request ran more queries than budget, or than the
+    # query_budget declared on its view when budget is not given
+    stats = query_stats(response)
+    if budget is None:
+        budget = stats['budget']
+    if budget is None:
+        raise AssertionError('No query budget is declared for this endpoint')
+    if stats['queries'] > budget:
+        raise AssertionError('%d queries, over the budget of %d; slowest:\n%s' % (
+            stats['queries'], budget,
+            '\n'.join('%.3f ms %s' % (ms, sql) for ms, sql in stats['slowest']),
+        ))
+    return stats
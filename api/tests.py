@@ -1,3 +1,920 @@
-from django.test import TestCase
+import threading
+from datetime import datetime, time, timedelta
+from io import StringIO
+from math import asin, cos, radians, sin, sqrt
+from time import sleep
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db.models import F
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .allocators import best_fit, first_fit, get_allocator
+from .availability import availability_cache, court_statuses, invalidate_availability, \
+    next_free_slots, provision_schedules, weekly_availability
+from .bans import banned_by, exclude_banned
+from .geo import GRID_SIZE, grid_cell, within_box, within_distance
+from .models import Booking, Court, ExtendedUser, Image, Log, Racket, Review, Schedule, \
+    Shuttlecock, slot_mask
+from .ranking import court_score, top_courts
+from .search import AVAILABILITY_VERSION_KEY, cached_court_ids, compute_court_ids, filter_name, \
+    increment_search_version, search_key
+from .serializers import CourtSerializer
+from .testing import assert_query_budget
+
+
+class ScheduleClaimTest(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        self.court = Court.objects.create(owner=owner, name='court', price=100, court_count=1,
+                                          open=0, close=47, lat=13.75, long=100.55)
+        self.schedule, _ = Schedule.objects.get_or_create(
+            court=self.court, court_number=0, date=timezone.localdate())
+        self.schedules = Schedule.objects.filter(pk=self.schedule.pk)
+
+    def status(self):
+        self.schedule.refresh_from_db()
+        return self.schedule.status
+
+    def test_claim_sets_the_slots(self):
+        self.assertEqual(Schedule.claim(self.schedules, 10, 12), 1)
+        self.assertEqual(self.status(), slot_mask(10, 12))
+
+    def test_conflicting_claim_updates_no_row(self):
+        Schedule.claim(self.schedules, 10, 12)
+        self.assertEqual(Schedule.claim(self.schedules, 12, 14), 0)
+        self.assertEqual(Schedule.claim(self.schedules, 0, 47), 0)
+        self.assertEqual(self.status(), slot_mask(10, 12))
+
+    def test_adjacent_claim(self):
+        Schedule.claim(self.schedules, 10, 12)
+        self.assertEqual(Schedule.claim(self.schedules, 13, 14), 1)
+        self.assertEqual(self.status(), slot_mask(10, 14))
+
+    def test_release_clears_only_its_own_slots(self):
+        Schedule.claim(self.schedules, 10, 12)
+        Schedule.claim(self.schedules, 13, 14)
+        Schedule.release(self.schedules, 10, 12)
+        self.assertEqual(self.status(), slot_mask(13, 14))
+        self.assertEqual(Schedule.claim(self.schedules, 10, 12), 1)
+        self.assertEqual(Schedule.claim(self.schedules, 14, 15), 0)
+
+    def test_claim_skips_the_taken_rows(self):
+        other = Schedule.objects.create(court=self.court, court_number=1, date=self.schedule.date)
+        Schedule.claim(self.schedules, 10, 12)
+        both = Schedule.objects.filter(pk__in=[self.schedule.pk, other.pk])
+        self.assertEqual(Schedule.claim(both, 11, 11), 1)
+        other.refresh_from_db()
+        self.assertEqual(other.status, slot_mask(11, 11))
+        self.assertEqual(self.status(), slot_mask(10, 12))
+
+    def test_racket_book(self):
+        racket = Racket.objects.create(court=self.court, name='racket', price=20)
+        Schedule.objects.get_or_create(racket=racket, date=self.schedule.date)
+        self.assertEqual(racket.book(self.schedule.date, 10, 12), 0)
+        self.assertEqual(racket.book(self.schedule.date, 12, 13), 1)
+        racket.unbooked(self.schedule.date, 10, 12)
+        self.assertEqual(racket.book(self.schedule.date, 12, 13), 0)
+
+
+class CourtScheduleTest(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        self.court = Court.objects.create(owner=owner, name='court', price=100, court_count=2,
+                                          open=0, close=47, lat=13.75, long=100.55)
+        self.today = timezone.localdate()
+
+    def court_numbers(self):
+        return sorted(set(Schedule.objects.filter(court=self.court).values_list(
+            'court_number', flat=True)))
+
+    def test_created_court_can_be_booked(self):
+        self.assertEqual(Schedule.objects.filter(court=self.court).count(),
+                         2 * settings.BOOKING_HORIZON_DAYS)
+        self.assertEqual(self.court.book(self.today, 40, 41), (0, 0))
+
+    def test_court_count_change(self):
+        self.court.court_count = 3
+        self.court.save()
+        self.assertEqual(self.court_numbers(), [0, 1, 2])
+        self.court.court_count = 1
+        self.court.save()
+        self.assertEqual(self.court_numbers(), [0])
+
+    def test_booked_court_number_is_kept(self):
+        Schedule.claim(Schedule.objects.filter(court=self.court, court_number=1,
+                                               date=self.today), 40, 41)
+        self.court.court_count = 1
+        with self.assertRaises(ValidationError):
+            self.court.full_clean()
+        serializer = CourtSerializer(self.court, data={'court_count': 1}, partial=True)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('court_count', serializer.errors)
+
+    def test_rows_created_meanwhile_are_skipped(self):
+        # as if another process created the rows after they were read
+        with mock.patch.object(Schedule.objects, 'filter', return_value=Schedule.objects.none()):
+            provision_schedules(courts=[self.court])
+        self.assertEqual(Schedule.objects.filter(court=self.court).count(),
+                         2 * settings.BOOKING_HORIZON_DAYS)
+
+    def test_created_racket_can_be_booked(self):
+        racket = Racket.objects.create(court=self.court, name='racket', price=20)
+        self.assertEqual(Schedule.objects.filter(racket=racket).count(),
+                         settings.BOOKING_HORIZON_DAYS)
+        self.assertEqual(racket.book(self.today, 40, 41), 0)
+
+
+class GetDateTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('user')
+        ExtendedUser.objects.create(base_user=user, credit=1000)
+        Court.objects.create(owner=user, name='court', price=100, court_count=1,
+                             open=0, close=47, lat=13.75, long=100.55, is_verified=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_invalid_date_is_a_bad_request(self):
+        for date in ('2026-13-40', '2026-02-30', 'tomorrow'):
+            self.assertEqual(self.client.get('/api/court/', {'date': date}).status_code, 400)
+            self.assertEqual(self.client.post('/api/court/court/book/', {
+                'date': date, 'start': 40, 'end': 41}).status_code, 400)
+        self.assertEqual(self.client.get('/api/court/', {'day_of_the_week': 7}).status_code, 400)
+        self.assertEqual(self.client.get('/api/court/', {'day_of_the_week': 'x'}).status_code, 400)
+
+
+class CourtSaveTest(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        self.court = Court.objects.create(owner=owner, name='court', price=100, court_count=1,
+                                          open=0, close=47, lat=13.75, long=100.55)
+
+    def test_save_keeps_the_counters(self):
+        stale = Court.objects.get(pk=self.court.pk)
+        invalidate_availability(self.court.pk)
+        Court.objects.filter(pk=self.court.pk).update(rating_sum=F('rating_sum') + 4,
+                                                      rating_count=F('rating_count') + 1)
+        stale.price = 120
+        stale.save()
+        court = Court.objects.get(pk=self.court.pk)
+        self.assertEqual(court.price, 120)
+        self.assertEqual(court.availability_version, stale.availability_version + 1)
+        self.assertEqual((court.rating_sum, court.rating_count), (4, 1))
+
+
+class WeeklyAvailabilityTest(TestCase):
+
+    def test_passed_slots_of_today_are_not_free(self):
+        # ids are reused between tests, the cache entries would not be
+        availability_cache.clear()
+        owner = User.objects.create_user('owner')
+        court = Court.objects.create(owner=owner, name='court', price=100, court_count=2,
+                                     open=10, close=40, lat=13.75, long=100.55)
+        Racket.objects.create(court=court, name='racket', price=20)
+        noon = timezone.make_aware(datetime.combine(timezone.localdate(), time(12, 40)))
+        with mock.patch('django.utils.timezone.now', return_value=noon):
+            result = weekly_availability(court)
+        today, tomorrow = result['courts'][:2]
+        self.assertEqual(today[:25], [0] * 25)
+        self.assertEqual(today[25:41], [2] * 16)
+        self.assertEqual(tomorrow[10:41], [2] * 31)
+        self.assertEqual(result['rackets'][0]['free_slots'][0], list(range(25, 41)))
+        self.assertEqual(result['rackets'][0]['free_slots'][1], list(range(10, 41)))
+
+
+class AvailabilityCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        availability_cache.clear()
+        owner = User.objects.create_user('owner')
+        Court.objects.create(owner=owner, name='court', price=100, court_count=1,
+                             open=0, close=47, lat=13.75, long=100.55)
+        self.court = Court.objects.get(name='court')
+        self.date = timezone.localdate()
+
+    def test_statuses_are_cached(self):
+        self.assertEqual(court_statuses([self.court], self.date)[self.court.id], {0: 0})
+        self.assertIn(self.court.id, availability_cache.entries)
+
+    def test_rolled_back_statuses_are_not_cached(self):
+        with transaction.atomic():
+            self.assertEqual(self.court.book(self.date, 16, 17), (0, 0))
+            court_statuses([Court.objects.get(pk=self.court.pk)], self.date)
+            transaction.set_rollback(True)
+        # another process takes the version the rolled back booking had
+        # bumped; its invalidate_availability does not reach this cache
+        Court.objects.filter(pk=self.court.pk).update(
+            availability_version=F('availability_version') + 1)
+        court = Court.objects.get(pk=self.court.pk)
+        self.assertEqual(court_statuses([court], self.date)[court.id], {0: 0})
+
+
+class BookManyLimitTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('user')
+        ExtendedUser.objects.create(base_user=user, credit=10 ** 6)
+        Court.objects.create(owner=user, name='court', price=100, court_count=1,
+                             open=0, close=47, lat=13.75, long=100.55, is_verified=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.date = (timezone.localdate() + timedelta(days=1)).isoformat()
+
+    def book_many(self, data):
+        return self.client.post('/api/court/court/book_many/', data, format='json')
+
+    def test_weeks(self):
+        for weeks in (0, settings.BOOKING_HORIZON_DAYS // 7 + 1, 10 ** 9, 'x', None):
+            response = self.book_many({'date': self.date, 'start': 40, 'end': 41, 'weeks': weeks})
+            self.assertEqual(response.status_code, 400, weeks)
+        response = self.book_many({'date': self.date, 'start': 40, 'end': 41, 'weeks': 2})
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_slots(self):
+        slot = {'date': self.date, 'start': 40, 'end': 40}
+        response = self.book_many({'slots': [slot] * (settings.BOOK_MANY_MAX_SLOTS + 1)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.book_many({'slots': slot}).status_code, 400)
+        self.assertEqual(self.book_many({'slots': [slot]}).status_code, 200)
+
+
+class CursorTest(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        for i in range(3):
+            Court.objects.create(owner=owner, name='court %d' % i, price=100, court_count=1,
+                                 open=0, close=47, lat=13.75 + i / 100, long=100.55,
+                                 is_verified=True)
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def test_pages(self):
+        response = self.client.get('/api/court/', {'page_size': 2, 'sort_by': 'dist',
+                                                   'lat': 13.75, 'long': 100.55})
+        self.assertEqual(response.status_code, 200)
+        names = [court['name'] for court in response.data['results']]
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        names += [court['name'] for court in response.data['results']]
+        self.assertEqual(names, ['court 0', 'court 1', 'court 2'])
+
+    def test_cursor_of_another_ordering(self):
+        response = self.client.get('/api/court/', {'page_size': 2})
+        cursor = parse_qs(urlparse(response.data['next']).query)['cursor'][0]
+        response = self.client.get('/api/court/', {'cursor': cursor, 'sort_by': 'dist',
+                                                   'lat': 13.75, 'long': 100.55})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get('/api/court/', {'cursor': 'x'}).status_code, 404)
+
+
+class FilterNameTest(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        # decomposed e and a double space, as some keyboards send them
+        self.court = Court.objects.create(owner=owner, name='Smash  Cafe\u0301 Club', price=100,
+                                          court_count=1, open=0, close=47, lat=13.75,
+                                          long=100.55)
+        Court.objects.create(owner=owner, name='Arena', price=100, court_count=1, open=0,
+                             close=47, lat=13.75, long=100.55)
+
+    def names(self, q):
+        return [court.name for court in filter_name(Court.objects.all(), q)]
+
+    def test_normalized_name_matches(self):
+        for q in ('smash café', 'SMASH   CAFE\u0301', 'café', 'h c', 'é'):
+            self.assertEqual(self.names(q), [self.court.name], q)
+        self.assertEqual(self.names('cafe club'), [])
+
+
+class BannedByTest(TestCase):
+
+    def test_stale_ban_lists_expire(self):
+        cache.clear()
+        user = User.objects.create_user('user')
+        owner = User.objects.create_user('owner')
+        profile = ExtendedUser.objects.create(base_user=owner)
+        self.assertEqual(banned_by(user.id), frozenset())
+        # a ban made by another process, whose invalidation this cache misses
+        profile.ban_list.through.objects.create(extendeduser=profile, user=user)
+        self.assertEqual(banned_by(user.id), frozenset())
+        later = timezone.now().timestamp() + settings.BAN_CACHE_TIMEOUT + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(banned_by(user.id), {owner.id})
+
+
+class BanListChangeTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        # ids whose cache keys share a prefix
+        self.users = {user_id: User.objects.create_user('user %d' % user_id, id=user_id)
+                      for user_id in (1, 11)}
+        owner = User.objects.create_user('owner', id=20)
+        self.profile = ExtendedUser.objects.create(base_user=owner)
+
+    def test_add_and_remove(self):
+        user = self.users[1]
+        self.assertEqual(banned_by(user.id), frozenset())
+        self.profile.ban_list.add(user)
+        self.assertEqual(banned_by(user.id), {20})
+        self.profile.ban_list.remove(user)
+        self.assertEqual(banned_by(user.id), frozenset())
+        user.banned.add(self.profile)
+        self.assertEqual(banned_by(user.id), {20})
+        self.profile.ban_list.clear()
+        self.assertEqual(banned_by(user.id), frozenset())
+
+    def test_other_users_are_not_banned(self):
+        self.assertEqual(banned_by(11), frozenset())
+        self.profile.ban_list.add(self.users[1])
+        self.assertEqual(banned_by(1), {20})
+        self.assertEqual(banned_by(11), frozenset())
+        courts = Court.objects.filter(owner_id=20)
+        Court.objects.create(owner_id=20, name='court', price=100, court_count=1, open=0,
+                             close=47, lat=13.75, long=100.55)
+        self.assertEqual(exclude_banned(courts, self.users[1]).count(), 0)
+        self.assertEqual(exclude_banned(courts, self.users[11]).count(), 1)
+
+
+class QueryBudgetTest(TestCase):
+    # the endpoints as clients call them, with token authentication and
+    # nothing cached
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        ExtendedUser.objects.create(base_user=owner)
+        self.user = User.objects.create_user('user')
+        ExtendedUser.objects.create(base_user=self.user, credit=10 ** 6)
+        self.staff = User.objects.create_user('staff', is_staff=True)
+        ExtendedUser.objects.create(base_user=self.staff)
+        for i in range(3):
+            court = Court.objects.create(owner=owner, name='court %d' % i, price=100,
+                                         court_count=2, open=0, close=47, lat=13.75 + i / 100,
+                                         long=100.55, is_verified=True)
+            Racket.objects.create(court=court, name='racket', price=20)
+            Shuttlecock.objects.create(court=court, name='shuttlecock', price=20, count=10,
+                                       count_per_unit=12)
+            Image.objects.create(court=court, url='https://example.com/%d.jpg' % i)
+            Review.objects.create(court=court, user=self.user, score=4, review='good')
+            Log.objects.create(user=self.user, desc='log %d' % i)
+            for start in (10, 20):
+                self.book(court, start)
+        self.date = (timezone.localdate() + timedelta(days=1)).isoformat()
+
+    def book(self, court, start):
+        date = timezone.localdate() + timedelta(days=1)
+        court.book(date, start, start + 1)
+        Booking.objects.create(user=self.user, court=court, date=date,
+                               day_of_the_week=date.weekday(), start=start, end=start + 1,
+                               court_number=0, price=100)
+
+    def client_of(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        return client
+
+    def assert_budget(self, response):
+        self.assertLess(response.status_code, 300, response.content)
+        assert_query_budget(response)
+
+    def get(self, user, url, data=None):
+        cache.clear()
+        availability_cache.clear()
+        self.assert_budget(self.client_of(user).get(url, data))
+
+    def test_staff_lists(self):
+        for url in ('/api/user/', '/api/log/', '/api/document/'):
+            self.get(self.staff, url)
+
+    def test_court_reads(self):
+        self.get(self.user, '/api/court/')
+        self.get(self.user, '/api/court/', {'sort_by': 'dist', 'lat': 13.75, 'long': 100.55})
+        self.get(self.user, '/api/court/', {'sort_by': 'rating', 'name': 'court'})
+        self.get(self.user, '/api/court/court 1/')
+        self.get(self.user, '/api/court/court 1/availability/')
+        self.get(self.user, '/api/court/suggest/', {'q': 'cou'})
+        self.get(self.user, '/api/court/next_free/', {'slots': 2})
+        self.get(self.user, '/api/court/recommend/', {
+            'lat': 13.75, 'long': 100.55, 'dist': 5, 'date': self.date, 'start_time': 10,
+            'end_time': 12})
+
+    def test_user_retrieve(self):
+        self.get(self.user, '/api/user/user/')
+        self.get(self.staff, '/api/user/user/')
+
+    def test_book(self):
+        cache.clear()
+        availability_cache.clear()
+        self.assert_budget(self.client_of(self.user).post('/api/court/court 1/book/', {
+            'date': self.date, 'start': 30, 'end': 31}))
+
+    def test_user_bookings(self):
+        for user in (self.user, self.staff):
+            self.get(user, '/api/user/user/bookings/')
+            self.get(user, '/api/user/user/bookings/', {'active': 1})
+
+
+class AllocatorTest(TestCase):
+
+    def setUp(self):
+        self.court = Court(open=10, close=40, court_count=3)
+        # court 0 is free from 10 to 40, court 1 from 16 to 21, court 2
+        # from 14 to 25
+        self.statuses = {
+            0: 0,
+            1: slot_mask(10, 15) | slot_mask(22, 40),
+            2: slot_mask(10, 13) | slot_mask(26, 40),
+        }
+
+    def test_first_fit(self):
+        self.assertEqual(first_fit(self.court, self.statuses, 18, 19), [0, 1, 2])
+        self.assertEqual(first_fit(self.court, self.statuses, 12, 13), [0])
+
+    def test_best_fit_takes_the_tightest_gap(self):
+        self.assertEqual(best_fit(self.court, self.statuses, 18, 19), [1, 2, 0])
+        self.assertEqual(best_fit(self.court, self.statuses, 22, 24), [2, 0])
+
+    def test_full_court(self):
+        statuses = {court_number: slot_mask(10, 40) for court_number in range(3)}
+        self.assertEqual(first_fit(self.court, statuses, 18, 19), [])
+        self.assertEqual(best_fit(self.court, statuses, 18, 19), [])
+
+    def test_full_court_is_not_booked(self):
+        owner = User.objects.create_user('owner')
+        court = Court.objects.create(owner=owner, name='court', price=100, court_count=1,
+                                     open=0, close=47, lat=13.75, long=100.55)
+        date = timezone.localdate() + timedelta(days=1)
+        self.assertEqual(court.book(date, 0, 47), (0, 0))
+        self.assertEqual(court.book(date, 20, 21)[0], 1)
+
+    def test_get_allocator(self):
+        with override_settings(COURT_ALLOCATOR='api.allocators.first_fit'):
+            self.assertIs(get_allocator(), first_fit)
+        with override_settings(COURT_ALLOCATOR='api.allocators.best_fit'):
+            self.assertIs(get_allocator(), best_fit)
+
+
+class NextFreeTest(TestCase):
+
+    def setUp(self):
+        availability_cache.clear()
+        owner = User.objects.create_user('owner')
+        self.first = Court.objects.create(owner=owner, name='first', price=100, court_count=2,
+                                          open=10, close=20, lat=13.75, long=100.55,
+                                          is_verified=True)
+        self.second = Court.objects.create(owner=owner, name='second', price=100,
+                                           court_count=1, open=10, close=20, lat=13.75,
+                                           long=100.55, is_verified=True)
+        self.today = timezone.localdate()
+        self.tomorrow = self.today + timedelta(days=1)
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def claim(self, court, court_number, date, start, end):
+        Schedule.claim(Schedule.objects.filter(court=court, court_number=court_number,
+                                               date=date), start, end)
+
+    def slots(self, length, date, start, limit, courts=None):
+        return [(court.name, day, slot, free) for court, day, slot, free in next_free_slots(
+            courts or [self.first, self.second], length, date, start, limit)]
+
+    def test_earliest_slots_then_earlier_courts(self):
+        self.assertEqual(self.slots(2, self.tomorrow, 0, 3), [
+            ('first', self.tomorrow, 10, 2),
+            ('second', self.tomorrow, 10, 1),
+            ('first', self.tomorrow, 11, 2),
+        ])
+
+    def test_runs(self):
+        self.claim(self.first, 0, self.tomorrow, 12, 12)
+        self.assertEqual(self.slots(3, self.tomorrow, 10, 4, [self.first]), [
+            ('first', self.tomorrow, 10, 1),
+            ('first', self.tomorrow, 11, 1),
+            ('first', self.tomorrow, 12, 1),
+            ('first', self.tomorrow, 13, 2),
+        ])
+        # runs end by close, the next day starts at open
+        self.assertEqual(self.slots(3, self.tomorrow, 17, 3, [self.first]), [
+            ('first', self.tomorrow, 17, 2),
+            ('first', self.tomorrow, 18, 2),
+            ('first', self.tomorrow + timedelta(days=1), 10, 2),
+        ])
+
+    def test_passed_slots_of_today(self):
+        noon = timezone.make_aware(datetime.combine(self.today, time(12, 40)))
+        court = Court.objects.create(owner=self.first.owner, name='late', price=100,
+                                     court_count=1, open=0, close=47, lat=13.75,
+                                     long=100.55)
+        with mock.patch('django.utils.timezone.now', return_value=noon):
+            self.assertEqual(self.slots(1, self.today, 0, 1, [court]),
+                             [('late', self.today, 25, 1)])
+
+    def test_days_after_the_cached_week(self):
+        day = self.today + timedelta(days=10)
+        self.claim(self.first, 0, day, 10, 10)
+        self.claim(self.first, 1, day, 10, 10)
+        self.assertEqual(self.slots(1, day, 0, 2), [
+            ('second', day, 10, 1),
+            ('first', day, 11, 2),
+        ])
+
+    def test_bad_arguments(self):
+        for data in ({'slots': 'x'}, {'slots': 2, 'k': -1}, {'slots': 2, 'k': 51},
+                     {'slots': 2, 'k': 'x'}, {'slots': 2, 'start_time': 48},
+                     {'slots': 2, 'start_time': 'x'}):
+            response = self.client.get('/api/court/next_free/', data)
+            self.assertEqual(response.status_code, 400, data)
+        response = self.client.get('/api/court/next_free/', {'slots': 2, 'k': 1})
+        self.assertEqual(len(response.data), 1)
+
+
+def haversine(lat1, long1, lat2, long2):
+    a = sin(radians(lat2 - lat1) / 2) ** 2 + \
+        cos(radians(lat1)) * cos(radians(lat2)) * sin(radians(long2 - long1) / 2) ** 2
+    return 2 * 6371.0 * asin(min(1.0, sqrt(a)))
+
+
+class GeoTest(TestCase):
+    # 1 km north is this many degrees of latitude on the haversine sphere
+    KM = 1 / 111.19492664455873
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        # on a cell corner, so the courts around it are in four cells
+        self.lat = 200 * GRID_SIZE
+        self.long = 2000 * GRID_SIZE
+
+    def court(self, name, lat, long):
+        return Court.objects.create(owner=self.owner, name=name, price=100, court_count=1,
+                                    open=0, close=47, lat=lat, long=long)
+
+    def names(self, queryset):
+        return sorted(court.name for court in queryset)
+
+    def test_sql_distance_matches_python(self):
+        for i, (lat, long) in enumerate([(13.7, 100.5), (13.9, 100.4), (-33.9, 151.2),
+                                         (self.lat, self.long)]):
+            self.court('court %d' % i, lat, long)
+        for court in within_distance(Court.objects.all(), 13.75, 100.55, 20000):
+            self.assertAlmostEqual(court.distance,
+                                   haversine(13.75, 100.55, court.lat, court.long), 6)
+
+    def test_cells_around_a_corner(self):
+        for name, d_lat, d_long in (('ne', 1, 1), ('nw', 1, -1), ('se', -1, 1), ('sw', -1, -1)):
+            self.court(name, self.lat + d_lat * 0.001, self.long + d_long * 0.001)
+        self.assertEqual(len(set(Court.objects.values_list('geo_cell', flat=True))), 4)
+        queryset = within_distance(Court.objects.all(), self.lat, self.long, 1)
+        self.assertIn('"geo_cell" IN', str(queryset.query))
+        self.assertEqual(self.names(queryset), ['ne', 'nw', 'se', 'sw'])
+
+    def test_radius_edge(self):
+        self.court('inside', self.lat + 4.99 * self.KM, self.long)
+        self.court('outside', self.lat + 5.01 * self.KM, self.long)
+        # in the bounding box, out of the circle
+        self.court('corner', self.lat + 4 * self.KM,
+                   self.long + 4 * self.KM / cos(radians(self.lat)))
+        self.assertEqual(self.names(within_box(Court.objects.all(), self.lat, self.long, 5)),
+                         ['corner', 'inside'])
+        self.assertEqual(self.names(within_distance(Court.objects.all(), self.lat, self.long, 5)),
+                         ['inside'])
+
+    def test_large_radius_skips_the_cells(self):
+        self.court('near', self.lat, self.long)
+        self.court('far', self.lat + 99 * self.KM, self.long)
+        queryset = within_distance(Court.objects.all(), self.lat, self.long, 100)
+        self.assertNotIn('"geo_cell" IN', str(queryset.query))
+        self.assertEqual(self.names(queryset), ['far', 'near'])
+        self.assertEqual(Court.objects.get(name='far').geo_cell,
+                         grid_cell(self.lat + 99 * self.KM, self.long))
+
+
+class RatingTest(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        self.court = Court.objects.create(owner=owner, name='court', price=100, court_count=1,
+                                          open=0, close=47, lat=13.75, long=100.55)
+        self.users = [User.objects.create_user('user %d' % i) for i in range(2)]
+
+    def rate(self, user, score):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post('/api/court/court/rate_court/', {'score': score, 'review': 'ok'})
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def aggregates(self):
+        self.court.refresh_from_db()
+        return self.court.rating_sum, self.court.rating_count
+
+    def test_create_update_delete(self):
+        self.rate(self.users[0], 4)
+        self.assertEqual(self.aggregates(), (4, 1))
+        self.rate(self.users[0], 2)
+        self.assertEqual(self.aggregates(), (2, 1))
+        self.rate(self.users[1], 5)
+        self.assertEqual(self.aggregates(), (7, 2))
+        Review.objects.get(user=self.users[0]).delete()
+        self.assertEqual(self.aggregates(), (5, 1))
+        self.users[1].delete()
+        self.assertEqual(self.aggregates(), (0, 0))
+
+    def test_repair_ratings(self):
+        self.rate(self.users[0], 4)
+        self.rate(self.users[1], 3)
+        Court.objects.filter(pk=self.court.pk).update(rating_sum=1, rating_count=9)
+        out = StringIO()
+        call_command('repair_ratings', batch_size=1, stdout=out)
+        self.assertEqual(self.aggregates(), (7, 2))
+        self.assertIn('Repaired 1 courts', out.getvalue())
+        out = StringIO()
+        call_command('repair_ratings', stdout=out)
+        self.assertIn('Repaired 0 courts', out.getvalue())
+
+
+class SlowQuerySet:
+    # stands for a search queryset, counting how often it is run
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.runs = 0
+
+    def values_list(self, *fields, **kwargs):
+        self.runs += 1
+        sleep(0.1)
+        return self.ids
+
+
+class SearchCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_identical_searches_run_once(self):
+        queryset = SlowQuerySet([1, 2])
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            cached_court_ids(['court'], queryset))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[1, 2]] * 4)
+        self.assertEqual(queryset.runs, 1)
+
+    @override_settings(SEARCH_CACHE_LOCK_TIMEOUT=0.1)
+    def test_waiter_keeps_the_lock_of_its_owner(self):
+        key = search_key(['court'])
+        # another process runs the search and holds the lock
+        cache.add(key + ':lock', 1, 60)
+        self.assertEqual(compute_court_ids(key, SlowQuerySet([1])), [1])
+        self.assertIsNotNone(cache.get(key + ':lock'))
+
+    def test_versions(self):
+        queryset = SlowQuerySet([1])
+        cached_court_ids(['court'], queryset)
+        cached_court_ids(['court', 'date'], queryset, True)
+        self.assertEqual(queryset.runs, 2)
+        # a booking only changes the searches on free courts or rackets
+        increment_search_version(AVAILABILITY_VERSION_KEY)
+        cached_court_ids(['court'], queryset)
+        self.assertEqual(queryset.runs, 2)
+        cached_court_ids(['court', 'date'], queryset, True)
+        self.assertEqual(queryset.runs, 3)
+        # a court change all of them
+        increment_search_version()
+        cached_court_ids(['court'], queryset)
+        cached_court_ids(['court', 'date'], queryset, True)
+        self.assertEqual(queryset.runs, 5)
+
+
+class SearchVersionTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        availability_cache.clear()
+        owner = User.objects.create_user('owner')
+        Court.objects.create(owner=owner, name='court', price=100, court_count=1, open=0,
+                             close=47, lat=13.75, long=100.55)
+        self.court = Court.objects.get(name='court')
+
+    def test_committed_changes_bump_the_versions(self):
+        keys = (search_key([]), search_key([], True))
+        self.court.book(timezone.localdate(), 10, 11)
+        self.assertEqual(search_key([]), keys[0])
+        self.assertNotEqual(search_key([], True), keys[1])
+        keys = (search_key([]), search_key([], True))
+        self.court.price = 120
+        self.court.save()
+        self.assertNotEqual(search_key([]), keys[0])
+        self.assertNotEqual(search_key([], True), keys[1])
+
+
+class SparseFieldsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('owner', first_name='first')
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.add_courts(3)
+
+    def add_courts(self, count):
+        for _ in range(count):
+            court = Court.objects.create(owner=self.owner, name='court %d' % Court.objects.count(),
+                                         price=100, court_count=1, open=0, close=47, lat=13.75,
+                                         long=100.55, is_verified=True)
+            Image.objects.create(court=court, url='https://example.com/%d.jpg' % court.id)
+            Review.objects.create(court=court, user=self.owner, score=4, review='good')
+
+    def courts(self, **data):
+        response = self.client.get('/api/court/', data)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def test_fields(self):
+        base = ['id', 'name', 'price', 'rating_count', 'avg_score', 'distance', 'image']
+        self.assertEqual(list(self.courts().data['results'][0]), base)
+        self.assertEqual(list(self.courts(fields='name,id').data['results'][0]), ['id', 'name'])
+        # unknown names are ignored, as an unknown expand alone
+        self.assertEqual(list(self.courts(fields='name,bogus').data['results'][0]), ['name'])
+        self.assertEqual(list(self.courts(expand='bogus').data['results'][0]), base)
+        response = self.client.get('/api/court/court 0/', {'fields': 'price,name,bogus'})
+        self.assertEqual(response.data, {'name': 'court 0', 'price': 100})
+
+    def test_expand(self):
+        court = self.courts(expand='owner,reviews,images', fields='id').data['results'][0]
+        self.assertEqual(list(court), ['id', 'owner', 'reviews', 'images'])
+        self.assertEqual(court['owner'], {'username': 'owner', 'first_name': 'first',
+                                          'last_name': ''})
+        self.assertEqual(court['reviews'], [{'review': 'good', 'score': 4}])
+        self.assertEqual([image['url'] for image in court['images']],
+                         ['https://example.com/%d.jpg' % court['id']])
+
+    def test_expanded_query_count(self):
+        queries = self.courts(expand='owner,reviews,images').query_stats['queries']
+        self.add_courts(3)
+        # the search version is bumped on commit, which a TestCase never does
+        cache.clear()
+        response = self.courts(expand='owner,reviews,images')
+        self.assertEqual(len(response.data['results']), 6)
+        self.assertEqual(response.query_stats['queries'], queries)
+        assert_query_budget(response)
+
+
+class RankingTest(TestCase):
+
+    def test_court_score(self):
+        # next to the centre, rated as the prior, free price, all free
+        self.assertAlmostEqual(court_score(0, 5, 0, 0, 0, 1), 0.35 + 0.3 * 0.6 + 0.15 + 0.2)
+        self.assertAlmostEqual(court_score(5, 5, 0, 0, 0, 1), 0.3 * 0.6 + 0.15 + 0.2)
+        self.assertAlmostEqual(court_score(9, 5, 0, 0, 0, 1), court_score(5, 5, 0, 0, 0, 1))
+        self.assertAlmostEqual(court_score(0, 5, 0, 0, 200, 0), 0.35 + 0.3 * 0.6 + 0.075)
+        # one 5 does not beat many 4.5s
+        self.assertLess(court_score(0, 5, 5, 1, 100, 1), court_score(0, 5, 45, 10, 100, 1))
+
+    def test_top_courts(self):
+        candidates = [
+            (1, 4.0, 0, 0, 100, 2, 2),
+            (2, 1.0, 0, 0, 100, 2, 2),
+            (3, 1.0, 0, 0, 100, 2, 0),
+            (4, 1.0, 0, 0, 100, 2, None),
+            (5, 1.0, 0, 0, 100, 2, 1),
+        ]
+        ranked = top_courts(iter(candidates), 4, 5)
+        # no availability asked counts as free, ties go to the lower id, a
+        # near court with nothing free still beats a far one
+        self.assertEqual([court_id for _, court_id in ranked], [2, 4, 5, 3])
+        self.assertEqual([score for score, _ in ranked],
+                         sorted([score for score, _ in ranked], reverse=True))
+        self.assertEqual(top_courts(iter(candidates), 10, 5)[-1][1], 1)
+        self.assertEqual(top_courts(iter([]), 5, 5), [])
+
+
+class RecommendTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create_user('owner')
+        for i in range(3):
+            Court.objects.create(owner=owner, name='court %d' % i, price=100 + i, court_count=1,
+                                 open=0, close=47, lat=13.75 + i / 100, long=100.55,
+                                 is_verified=True)
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def recommend(self, **data):
+        return self.client.get('/api/court/recommend/', dict({'lat': 13.75, 'long': 100.55,
+                                                              'dist': 5}, **data))
+
+    def test_recommend(self):
+        response = self.recommend(k=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([court['name'] for court in response.data], ['court 0', 'court 1'])
+        self.assertEqual(response.data[0]['distance'], 0)
+
+    def test_bad_arguments(self):
+        for data in ({'dist': -1}, {'dist': 0}, {'dist': 'x'}, {'dist': 'inf'}, {'dist': 'nan'},
+                     {'k': 0}, {'k': -1}, {'k': 51}, {'k': 'x'}):
+            self.assertEqual(self.recommend(**data).status_code, 400, data)
+
+
+class ETagTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        ExtendedUser.objects.create(base_user=self.owner)
+        self.user = User.objects.create_user('user')
+        ExtendedUser.objects.create(base_user=self.user, credit=1000)
+        self.court = Court.objects.create(owner=self.owner, name='court', price=100,
+                                          court_count=1, open=0, close=47, lat=13.75,
+                                          long=100.55, is_verified=True)
+        self.shuttlecock = Shuttlecock.objects.create(court=self.court, name='shuttlecock',
+                                                      price=20, count=10, count_per_unit=12)
+        date = timezone.localdate() + timedelta(days=1)
+        self.booking = Booking.objects.create(user=self.user, court=self.court, date=date,
+                                              day_of_the_week=date.weekday(), start=40, end=41,
+                                              court_number=0, price=100)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.etags = {url: self.get(url)['ETag'] for url in self.urls}
+
+    urls = ('/api/court/court/', '/api/user/user/')
+
+    def get(self, url, etag=None):
+        if etag is None:
+            response = self.client.get(url)
+        else:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertIn(response.status_code, (200, 304))
+        return response
+
+    def modified(self):
+        return [url for url in self.urls if self.get(url, self.etags[url]).status_code == 200]
+
+    def test_unchanged(self):
+        self.assertEqual(self.modified(), [])
+        response = self.get('/api/court/court/', self.etags['/api/court/court/'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], self.etags['/api/court/court/'])
+        self.assertEqual(self.get('/api/court/court/', '*').status_code, 304)
+        # the representation depends on the query string
+        self.assertEqual(self.client.get('/api/court/court/', {'fields': 'name'},
+                                         HTTP_IF_NONE_MATCH=self.etags['/api/court/court/']
+                                         ).status_code, 200)
+
+    def test_saves_of_hidden_fields(self):
+        User.objects.get(pk=self.user.pk).save()
+        self.owner.last_login = timezone.now()
+        self.owner.save()
+        self.shuttlecock.count = 5
+        self.shuttlecock.save()
+        Racket.objects.create(court=self.court, name='racket', price=20)
+        self.assertEqual(self.modified(), [])
+
+    def test_court_change(self):
+        self.court.price = 120
+        self.court.save()
+        # the court shows in the bookings of the profile
+        self.assertEqual(self.modified(), list(self.urls))
+
+    def test_owner_rename(self):
+        owner = User.objects.get(pk=self.owner.pk)
+        owner.first_name = 'first'
+        owner.save()
+        self.assertEqual(self.modified(), list(self.urls))
+
+    def test_user_changes(self):
+        self.user.extended.credit = 900
+        self.user.extended.save()
+        self.assertEqual(self.modified(), ['/api/user/user/'])
+        self.etags['/api/user/user/'] = self.get('/api/user/user/')['ETag']
+        self.user.last_name = 'last'
+        self.user.save()
+        self.assertEqual(self.modified(), ['/api/user/user/'])
+
+    def test_buy_shuttlecock(self):
+        response = self.client.post('/api/booking/%d/buy_shuttlecock/' % self.booking.id,
+                                    {'id': self.shuttlecock.id, 'count': 2})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.modified(), ['/api/user/user/'])
+        self.etags['/api/user/user/'] = self.get('/api/user/user/')['ETag']
+        # the name of a bought shuttlecock shows in the profile
+        self.shuttlecock.name = 'feather'
+        self.shuttlecock.save()
+        self.assertEqual(self.modified(), ['/api/user/user/'])
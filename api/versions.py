@@ -0,0 +1,54 @@
+import hashlib
+
+from django.db.models import F
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import Court, ExtendedUser
+
+# Court.version and ExtendedUser.version change with every write that shows
+# in the retrieve output of the court or the user profile. The bumps are
+# UPDATE ... SET version = version + 1 (see api.signals), so they never go
+# back, and Court.save and ExtendedUser.save increment the same way.
+
+
+def bump_user_versions(user_ids):
+    # the profiles of the auth users user_ids
+    ExtendedUser.objects.filter(base_user_id__in=user_ids).update(version=F('version') + 1)
+
+
+def bump_booker_versions(court_ids):
+    # the profiles that show one of the courts through a booking
+    ExtendedUser.objects.filter(base_user__bookings__court_id__in=court_ids).update(
+        version=F('version') + 1)
+
+
+def bump_court_versions(court_ids):
+    Court.objects.filter(id__in=court_ids).update(version=F('version') + 1)
+    bump_booker_versions(court_ids)
+
+
+def current_slot():
+    # Booking.is_active of a profile can change every half hour
+    now = timezone.localtime(timezone.now())
+    return '%s-%d' % (now.date().isoformat(), now.hour * 2 + (now.minute >= 30))
+
+
+def resource_etag(request, *parts):
+    # strong ETag of a resource version; the query string (?fields=) and
+    # the Accept header choose the representation
+    key = ':'.join([str(part) for part in parts] + [
+        request.META.get('QUERY_STRING', ''), request.META.get('HTTP_ACCEPT', '')])
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+
+def not_modified(request, etag):
+    # 304 response when If-None-Match has etag, else None
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in etags or '*' in etags:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        response['ETag'] = etag
+        return response
+    return None
@@ -1,11 +1,28 @@
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, F, FloatField, IntegerField, OuterRef, Subquery, Sum, \
+    Value, When
+from django.db.models.functions import Cast, Coalesce
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from rest_framework.views import APIView
 
 from .serializers import *
+from .geo import distance_expression, within_distance
+from .bans import banned_by, exclude_banned
+from .availability import booking_dates, free_court_count, free_racket_count, free_rackets, \
+    has_free_court, next_date, next_free_slots, weekly_availability
+from .pagination import KeysetPagination
+from .projections import BOOKING_VALUES, COURT_VALUES, booking_list, court_details, court_list, \
+    court_list_values, sparse, user_profiles
+from .querystats import query_budget
+from .ranking import top_courts
+from .search import cached_court_ids, filter_name, normalize, suggest_courts
+from .versions import current_slot, not_modified, resource_etag
 
 from .stt import sample_recognize
 
@@ -40,6 +57,48 @@ def check_arguments(request_arr, args):
         return 1, Response(response, status=status.HTTP_400_BAD_REQUEST)
     return 0,
 
+def get_date(request_arr):
+    # a date is given as `date` (YYYY-MM-DD) or as the next `day_of_the_week`;
+    # an invalid one is answered with 400
+    if 'date' in request_arr:
+        try:
+            return datetime.strptime(request_arr['date'], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            raise ParseError('date must be a valid YYYY-MM-DD date')
+    if 'day_of_the_week' in request_arr:
+        try:
+            day_of_the_week = int(request_arr['day_of_the_week'])
+        except (TypeError, ValueError):
+            day_of_the_week = -1
+        if not 0 <= day_of_the_week <= 6:
+            raise ParseError('day_of_the_week must be between 0 and 6')
+        return next_date(day_of_the_week)
+    return None
+
+
+def check_booking_slot(court, date, start, end):
+    lc = timezone.localtime(timezone.now())
+
+    if ( date < lc.date() or date == lc.date() and (lc.hour*2)+(lc.minute >= 30) > start):
+        return 1, Response(
+            {'message': 'time is already passed'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    if date not in booking_dates():
+        return 1, Response(
+            {'message': 'date is too far ahead'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    if ( court.open > start or court.close < end ):
+        return 1, Response(
+            {'message': 'court is closed at that time'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return 0,
+
+
 def check_string_len(arr):
     # [[name, value, limit],...]
     string_len_exceed_max = []
@@ -62,6 +121,7 @@ def create_log(user, desc):
 class UserViewSet(viewsets.ModelViewSet):
     queryset = ExtendedUser.objects.all()
     serializer_class = ExtendedUserSerializer
+    pagination_class = KeysetPagination
 
     def create(self, request):
         if not request.user.is_staff:
@@ -121,27 +181,36 @@ class UserViewSet(viewsets.ModelViewSet):
             status=status.HTTP_200_OK
         )
 
+    @query_budget(12)
     def list(self, request):
         if not request.user.is_staff:
             return err_no_permission
-        queryset = ExtendedUser.objects.all()
         serializer_class = ExtendedUserSerializer
-        return Response(serializer_class(queryset, many=True).data,
-                        status=status.HTTP_200_OK)
+        queryset = serializer_class.eager_loading(ExtendedUser.objects.order_by('id'))
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(serializer_class(page, many=True).data)
 
+    @query_budget(12)
     def retrieve(self, request, pk=None):
         if pk != request.user.username and not request.user.is_staff:
             return err_no_permission
-        queryset = User.objects.all()
-        try:
-            user = queryset.get(username=pk).extended
-            serializer_class = ExtendedUserSerializer
-            return Response(
-                serializer_class(user, many=False).data,
-                status=status.HTTP_200_OK
-            )
-        except:
+        row = ExtendedUser.objects.filter(base_user__username=pk).values('id', 'version').first()
+        if row is None:
             return err_not_found
+        etag = resource_etag(request, 'user', row['id'], row['version'], current_slot())
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        if settings.FAST_READ_PATH:
+            data = user_profiles(ExtendedUser.objects.filter(id=row['id']))[0]
+        else:
+            serializer_class = ExtendedUserSerializer
+            user = serializer_class.eager_loading(ExtendedUser.objects.all()).get(id=row['id'])
+            data = serializer_class(user, many=False).data
+        response = Response(data, status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        return response
 
     @action(methods=['POST'], detail=True)
     def change_password(self, request, pk=None):
@@ -163,7 +232,8 @@ class UserViewSet(viewsets.ModelViewSet):
             return Response(
                 {
                     'message': 'Password has been set',
-                    'result': serializer_class(user.extended, many=False).data
+                    'result': serializer_class(serializer_class.eager_loading(
+                        ExtendedUser.objects.all()).get(base_user=user), many=False).data
                 },
                 status=status.HTTP_200_OK,
             )
@@ -193,7 +263,8 @@ class UserViewSet(viewsets.ModelViewSet):
         return Response(
             {
                 'message': 'credit added',
-                'result': serializer_class(user.extended, many=False).data
+                'result': serializer_class(serializer_class.eager_loading(
+                    ExtendedUser.objects.all()).get(base_user=user), many=False).data
             },
             status=status.HTTP_200_OK
         )
@@ -211,22 +282,51 @@ class UserViewSet(viewsets.ModelViewSet):
             status=status.HTTP_200_OK
         )
 
+    @action(methods=['GET'], detail=True)
+    @query_budget(8)
+    def bookings(self, request, pk=None):
+        # the bookings of the user, newest first, or with ?active=1 the ones
+        # not started yet, the next one first
+        if pk == request.user.username:
+            user_id = request.user.id
+        elif request.user.is_staff:
+            user_id = User.objects.filter(username=pk).values_list('id', flat=True).first()
+            if user_id is None:
+                return err_not_found
+        else:
+            return err_no_permission
+        queryset = Booking.objects.filter(user_id=user_id)
+        if request.GET.get('active', '') not in ('', '0', 'false'):
+            queryset = queryset.filter(play_datetime__gt=timezone.now()).order_by('play_datetime', 'id')
+        else:
+            queryset = queryset.order_by('-play_datetime', '-id')
+
+        if settings.FAST_READ_PATH:
+            page = self.paginate_queryset(queryset.values(*BOOKING_VALUES))
+            return self.get_paginated_response(booking_list(page))
+        serializer_class = BookingSerializer
+        page = self.paginate_queryset(serializer_class.eager_loading(queryset))
+        return self.get_paginated_response(serializer_class(page, many=True).data)
+
 
 class LogViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserLogSerializer
+    pagination_class = KeysetPagination
 
+    @query_budget(3)
     def list(self, request):
         if request.user.is_staff:
-            queryset = User.objects.all()
             serializer_class = UserLogSerializer
-            return Response(serializer_class(queryset, many=True).data,
-                            status=status.HTTP_200_OK, )
+            queryset = serializer_class.eager_loading(User.objects.order_by('id'))
+            page = self.paginate_queryset(queryset)
+            return self.get_paginated_response(serializer_class(page, many=True).data)
         try:
-            queryset = request.user.logs
+            # newest first
+            queryset = request.user.logs.order_by('-id')
+            page = self.paginate_queryset(queryset)
             serializer_class = LogSerializer
-            return Response(serializer_class(queryset, many=True).data,
-                            status=status.HTTP_200_OK, )
+            return self.get_paginated_response(serializer_class(page, many=True).data)
         except:
             return Response({'message': 'No log with your username is found'},
                             status=status.HTTP_404_NOT_FOUND)
@@ -246,6 +346,7 @@ class LogViewSet(viewsets.ModelViewSet):
 class DocumentViewSet(viewsets.ModelViewSet):
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
+    pagination_class = KeysetPagination
 
     def create(self, request):
         
@@ -314,13 +415,14 @@ class DocumentViewSet(viewsets.ModelViewSet):
         except:
             return err_not_found
 
+    @query_budget(3)
     def list(self, request):
         if not request.user.is_staff:
             return err_no_permission
-        queryset = User.objects.all()
         serializer_class = UserDocumentSerializer
-        return Response(serializer_class(queryset, many=True).data,
-                        status=status.HTTP_200_OK)
+        queryset = serializer_class.eager_loading(User.objects.order_by('id'))
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(serializer_class(page, many=True).data)
 
 
 class BookingViewSet(viewsets.ModelViewSet):
@@ -340,15 +442,8 @@ class BookingViewSet(viewsets.ModelViewSet):
         if not user.is_staff and user != booking.user:
             return err_not_allowed
         price = booking.price
-        dist = timedelta(days=booking.day_of_the_week) - \
-               timedelta(days=timezone.localtime(timezone.now()).weekday())
-        if dist < timedelta(days=0):
-            dist += timedelta(days=7)
-        effective_date = booking.booked_date + dist
-        effective_date.replace(hour=0, minute=0, second=0)
-        print(effective_date)
-        print(timezone.now())
-        if timezone.localtime(timezone.now()) > effective_date:
+        dist = timedelta(days=booking.days_left)
+        if dist <= timedelta(days=0):
             # case 1: already past the date
             return Response(
                 {'message': 'Already past cancellation time'},
@@ -358,12 +453,12 @@ class BookingViewSet(viewsets.ModelViewSet):
         booking.court.unbooked(court_number=booking.court_number,
                                start=booking.start,
                                end=booking.end,
-                               day_of_the_week=booking.day_of_the_week)
+                               date=booking.date)
         racketSet = RacketBooking.objects.filter(booking=booking)
         for book in racketSet:
             book.racket.unbooked(start=book.booking.start,
                                  end=book.booking.end,
-                                 day_of_the_week=book.booking.day_of_the_week)
+                                 date=book.booking.date)
             if dist >= timedelta(days=0):
                 # case : before the date
                 refund += book.price
@@ -406,9 +501,8 @@ class BookingViewSet(viewsets.ModelViewSet):
             court = booking.court
         except:
             return err_not_found
-        rackets = [racket for racket in court.rackets.all()
-                   if racket.check_collision(
-                booking.day_of_the_week, booking.start, booking.end) == 0]
+        rackets = free_rackets([court], booking.date,
+                               booking.start, booking.end)[court.id]
         return Response(RacketSerializer(rackets, many=True).data,
                         status=status.HTTP_200_OK)
 
@@ -439,7 +533,7 @@ class BookingViewSet(viewsets.ModelViewSet):
 
         start = booking.start
         end = booking.end
-        day_of_the_week = booking.day_of_the_week
+        date = booking.date
         price = racket.price * (end - start) / 2
 
         if request.user.extended.credit < price:
@@ -448,7 +542,7 @@ class BookingViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_402_PAYMENT_REQUIRED,
             )
 
-        response = racket.book(day_of_the_week, start, end)
+        response = racket.book(date, start, end)
         if response != 0:
             return Response(
                 {'message': 'racket is not free'},
@@ -516,42 +610,38 @@ class BookingViewSet(viewsets.ModelViewSet):
 class CourtViewSet(viewsets.ModelViewSet):
     queryset = Court.objects.all()
     serializer_class = CourtSerializer
+    pagination_class = KeysetPagination
 
     @action(detail=True, methods=['POST'], )
+    @query_budget(14)
     def book(self, request, pk=None):
-        response = check_arguments(request.data, ['start', 'end', 'day_of_the_week'])
+        response = check_arguments(request.data, ['start', 'end'])
         if response[0] != 0:
             return response[1]
+        date = get_date(request.data)
+        if date is None:
+            return Response({'Missing argument': 'date or day_of_the_week'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
         start = int(request.data['start'])
         end = int(request.data['end'])
-        day_of_the_week = int(request.data['day_of_the_week'])
         user = request.user
         try:
             court = Court.objects.get(name=pk)
         except:
             return err_not_found
 
-        lc = timezone.localtime(timezone.now())
-
-        if ( day_of_the_week == lc.weekday() and (lc.hour*2)+(lc.minute >= 30) > start):
-            return Response(
-                {'message': 'time is already passed'},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        response = check_booking_slot(court, date, start, end)
+        if response[0] != 0:
+            return response[1]
 
-        if ( court.open > start or court.close < end ):
-            return Response(
-                {'message': 'court is closed at that time'},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
         price = court.price * (end - start) / 2
         if user.extended.credit < price:
             return Response(
                 {'message': 'not enough credit'},
                 status=status.HTTP_402_PAYMENT_REQUIRED,
             )
-        response = court.book(day_of_the_week, start, end)
+        response = court.book(date, start, end)
         if response[0] != 0:
             return Response(
                 {'message': 'court is not free'},
@@ -561,7 +651,7 @@ class CourtViewSet(viewsets.ModelViewSet):
         user.extended.save()
         court.owner.extended.credit += price
         court.owner.extended.save()
-        booking = Booking.objects.create(user=user, day_of_the_week=day_of_the_week, court=court,
+        booking = Booking.objects.create(user=user, date=date, day_of_the_week=date.weekday(), court=court,
                                start=start, end=end, court_number=response[1], price=price)
         create_log(user=user, desc='User %s booked court %s'
                                    % (user.username, court.name,))
@@ -570,6 +660,240 @@ class CourtViewSet(viewsets.ModelViewSet):
             status=status.HTTP_200_OK,
         )
 
+    @action(detail=True, methods=['POST'], )
+    def book_many(self, request, pk=None):
+        # book several slots, given as a list or as a weekly recurrence, all
+        # or nothing
+        user = request.user
+        try:
+            court = Court.objects.get(name=pk)
+        except:
+            return err_not_found
+
+        if 'slots' in request.data:
+            if not isinstance(request.data['slots'], list) or \
+                    len(request.data['slots']) > settings.BOOK_MANY_MAX_SLOTS:
+                return Response({'message': 'slots must be a list of at most %d slots'
+                                            % settings.BOOK_MANY_MAX_SLOTS},
+                                status=status.HTTP_400_BAD_REQUEST)
+            slots = []
+            for slot in request.data['slots']:
+                response = check_arguments(slot, ['start', 'end'])
+                if response[0] != 0:
+                    return response[1]
+                date = get_date(slot)
+                if date is None:
+                    return Response({'Missing argument': 'date or day_of_the_week'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                slots.append((date, int(slot['start']), int(slot['end'])))
+        else:
+            response = check_arguments(request.data, ['start', 'end', 'weeks'])
+            if response[0] != 0:
+                return response[1]
+            date = get_date(request.data)
+            if date is None:
+                return Response({'Missing argument': 'date or day_of_the_week'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            try:
+                weeks = int(request.data['weeks'])
+            except (TypeError, ValueError):
+                weeks = 0
+            max_weeks = min(settings.BOOKING_HORIZON_DAYS // 7, settings.BOOK_MANY_MAX_SLOTS)
+            if not 1 <= weeks <= max_weeks:
+                return Response({'message': 'weeks must be between 1 and %d' % max_weeks},
+                                status=status.HTTP_400_BAD_REQUEST)
+            start = int(request.data['start'])
+            end = int(request.data['end'])
+            slots = [(date + timedelta(weeks=week), start, end)
+                     for week in range(0, weeks)]
+        if not slots:
+            return Response({'message': 'no slot to book'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        for date, start, end in slots:
+            response = check_booking_slot(court, date, start, end)
+            if response[0] != 0:
+                return response[1]
+
+        total = sum(court.price * (end - start) / 2 for date, start, end in slots)
+        if user.extended.credit < total:
+            return Response(
+                {'message': 'not enough credit'},
+                status=status.HTTP_402_PAYMENT_REQUIRED,
+            )
+
+        bookings = []
+        with transaction.atomic():
+            for date, start, end in slots:
+                response = court.book(date, start, end)
+                if response[0] != 0:
+                    transaction.set_rollback(True)
+                    return Response(
+                        {'message': 'court is not free on %s' % date},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+                bookings.append(Booking(user=user, date=date, day_of_the_week=date.weekday(),
+                                        court=court, start=start, end=end,
+                                        court_number=response[1],
+                                        play_datetime=Booking.play_datetime_of(date, start),
+                                        price=court.price * (end - start) / 2))
+            user.extended.credit -= total
+            user.extended.save()
+            court.owner.extended.credit += total
+            court.owner.extended.save()
+            Booking.objects.bulk_create(bookings)
+            Log.objects.bulk_create([
+                Log(user=user, desc='User %s booked court %s' % (user.username, court.name,))
+                for booking in bookings
+            ])
+            booking_ids = [booking.id for booking in bookings]
+            if None in booking_ids:
+                # the database does not return ids from bulk inserts; the
+                # transaction holds the write lock, so ours are the latest
+                booking_ids = list(reversed(Booking.objects.filter(user=user, court=court)
+                                            .order_by('-id')
+                                            .values_list('id', flat=True)[:len(bookings)]))
+        return Response(
+            {'message': 'courts have been booked', 'booking_ids': booking_ids},
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=False, methods=['GET'], )
+    @query_budget(5)
+    def next_free(self, request):
+        # earliest slots where `slots` consecutive half hours are free, at
+        # one court or at the courts matching name and distance filters
+        response = check_arguments(request.GET, ['slots'])
+        if response[0] != 0:
+            return response[1]
+        try:
+            length = int(request.GET['slots'])
+        except ValueError:
+            length = 0
+        if length < 1 or length > 48:
+            return Response({'message': 'slots must be between 1 and 48'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        date = get_date(request.GET) or timezone.localdate()
+        try:
+            start = int(request.GET.get('start_time', 0))
+        except ValueError:
+            start = -1
+        if start < 0 or start > 47:
+            return Response({'message': 'start_time must be between 0 and 47'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.GET.get('k', 5))
+        except ValueError:
+            limit = 0
+        if limit < 1 or limit > 50:
+            return Response({'message': 'k must be between 1 and 50'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        max_dist = float(request.GET.get('dist', -1))
+        if max_dist > -1:
+            response = check_arguments(request.GET, ['lat', 'long', ])
+            if response[0] != 0:
+                return response[1]
+
+        queryset = Court.objects.filter(is_verified=True)
+        queryset = exclude_banned(queryset, request.user)
+        if 'court' in request.GET:
+            queryset = queryset.filter(name=request.GET['court'])
+        if request.GET.get('name', '') != '':
+            queryset = filter_name(queryset, request.GET['name'])
+        if max_dist != -1:
+            lat = float(request.GET['lat'])
+            long = float(request.GET['long'])
+            queryset = within_distance(queryset, lat, long, max_dist).order_by('distance', 'id')
+
+        slots = next_free_slots(queryset, length, date, start, limit)
+        return Response(
+            [
+                {
+                    'court': court.name,
+                    'date': day,
+                    'start': slot,
+                    'end': slot + length - 1,
+                    'free_courts': free,
+                }
+                for court, day, slot, free in slots
+            ],
+            status=status.HTTP_200_OK,
+        )
+
+    @action(detail=False, methods=['GET'], )
+    @query_budget(3)
+    def suggest(self, request):
+        # ids and names of the courts matching what has been typed so far
+        queryset = Court.objects.filter(is_verified=True)
+        queryset = exclude_banned(queryset, request.user)
+        courts = suggest_courts(queryset, request.GET.get('q', '')).values('id', 'name')
+        return Response(list(courts), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET'], )
+    @query_budget(5)
+    def recommend(self, request):
+        # the k best courts within dist of lat/long among those the list
+        # filters return, ranked on distance, rating, price and how many
+        # court_numbers are free for the requested slots
+        response = check_arguments(request.GET, ['lat', 'long', 'dist'])
+        if response[0] != 0:
+            return response[1]
+        try:
+            max_dist = float(request.GET['dist'])
+        except ValueError:
+            max_dist = 0
+        if not 0 < max_dist < float('inf'):
+            return Response({'message': 'dist must be a positive number of km'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            k = int(request.GET.get('k', 5))
+        except ValueError:
+            k = 0
+        if k < 1 or k > 50:
+            return Response({'message': 'k must be between 1 and 50'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        response = self.search_courts(request)
+        if response[0] != 0:
+            return response[1]
+        queryset = response[1]
+        date = get_date(request.GET)
+        start = int(request.GET.get('start_time', -1))
+        end = int(request.GET.get('end_time', -1))
+        if date is not None and start != -1 and end != -1:
+            queryset = queryset.annotate(free_courts=free_court_count(date, start, end))
+        else:
+            queryset = queryset.annotate(free_courts=Value(None, output_field=IntegerField()))
+
+        candidates = queryset.values_list('id', 'distance', 'rating_sum', 'rating_count',
+                                          'price', 'court_count', 'free_courts')
+        ranked = top_courts(candidates.iterator(), k, max_dist)
+
+        courts = Court.objects.filter(id__in=[court_id for _, court_id in ranked]).annotate(
+            distance=distance_expression(float(request.GET['lat']), float(request.GET['long'])),
+            first_image=Subquery(
+                Image.objects.filter(court=OuterRef('pk')).order_by('timestamp', 'id').values('url')[:1],
+            ),
+        ).in_bulk()
+        serializer_class = CourtListSerializer
+        result = []
+        for score, court_id in ranked:
+            data = serializer_class(courts[court_id], context={'request': request}).data
+            data['score'] = round(score, 4)
+            result.append(data)
+        return Response(result, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['GET'], )
+    @query_budget(6)
+    def availability(self, request, pk=None):
+        try:
+            court = Court.objects.get(name=pk)
+        except:
+            return err_not_found
+        if court.owner_id in banned_by(request.user.id):
+            return err_no_permission
+
+        return Response(weekly_availability(court), status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['POST'], )
     def rate_court(self, request, pk=None):
         response = check_arguments(request.data, ['score', 'review'])
@@ -584,39 +908,54 @@ class CourtViewSet(viewsets.ModelViewSet):
         score = int(request.data['score'])
         review_text = request.data['review']
 
-        response = check_string_len(['review length', review_text, 200])
+        response = check_string_len([['review length', review_text, 200]])
         if response[0] != 0:
             return response[1]
 
+        if score < 0 or score > 5:
+            return err_invalid_input
+
         if user == court.owner:
             return Response(
                 {'message': 'You cannot rate your own court'},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        try:
-            review = Review.objects.get(user=user, court=court)
-            review.score = score
-            review.review = review_text
-            review.save()
-            review.full_clean()
-            message = 'Review updated'
-            create_log(
-                user=user,
-                desc='User %s has update the review for court %s'
-                     % (user.username, court.name,)
-            )
-        except ValidationError:
-            return err_invalid_input
-        except:
-            review = Review.objects.create(user=user, court=court,
-                                           score=score, review=review_text, )
-            message = 'Review created'
-            create_log(
-                user=user,
-                desc='User %s has create a review for court %s'
-                     % (user.username, court.name,)
-            )
+        # the review and the rating aggregates of the court change together
+        with transaction.atomic():
+            try:
+                review = Review.objects.select_for_update().get(user=user, court=court)
+            except Review.DoesNotExist:
+                review = None
+            if review is not None:
+                old_score = review.score
+                review.score = score
+                review.review = review_text
+                try:
+                    review.full_clean()
+                except ValidationError:
+                    return err_invalid_input
+                review.save()
+                Court.objects.filter(pk=court.pk).update(
+                    rating_sum=F('rating_sum') + score - old_score)
+                message = 'Review updated'
+                create_log(
+                    user=user,
+                    desc='User %s has update the review for court %s'
+                         % (user.username, court.name,)
+                )
+            else:
+                review = Review.objects.create(user=user, court=court,
+                                               score=score, review=review_text, )
+                Court.objects.filter(pk=court.pk).update(
+                    rating_sum=F('rating_sum') + score,
+                    rating_count=F('rating_count') + 1)
+                message = 'Review created'
+                create_log(
+                    user=user,
+                    desc='User %s has create a review for court %s'
+                         % (user.username, court.name,)
+                )
         return Response(
             {
                 'message': message,
@@ -826,98 +1165,152 @@ class CourtViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_200_OK
             )
 
+    @query_budget(5)
     def retrieve(self, request, pk=None):
-        try:
-            court = Court.objects.get(name=pk)
-        except:
+        rows = list(Court.objects.filter(name=pk).values(*COURT_VALUES, 'owner_id', 'version')[:2])
+        if len(rows) != 1:
             return err_not_found
-        try:
-            court.owner.extended.ban_list.get(username=request.user.username)
+        if rows[0]['owner_id'] in banned_by(request.user.id):
             return err_no_permission
-        except:
-            pass
+        etag = resource_etag(request, 'court', rows[0]['id'], rows[0]['version'])
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
 
-        serializer_class = CourtSerializer
-        return Response(serializer_class(court, many=False).data,
-                        status=status.HTTP_200_OK, )
+        if settings.FAST_READ_PATH:
+            data = sparse(court_details(rows)[0], query_param_set(request, 'fields'))
+        else:
+            serializer_class = CourtSerializer
+            court = serializer_class.eager_loading(Court.objects.all()).get(id=rows[0]['id'])
+            data = serializer_class(court, many=False, context={'request': request}).data
+        response = Response(data, status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        return response
 
-    def list(self, request):
+    def search_courts(self, request):
+        # (0, the courts matching the search filters of request) or
+        # (1, error response); distance is annotated when lat/long are used
         queryset = Court.objects.all()
 
         name = request.GET.get('name', '')
         min_rating = float(request.GET.get('rating', -1))
         if min_rating > 5:
-            return Response({'message': 'minimum rating cannot exceed 5'},
-                            status=status.HTTP_400_BAD_REQUEST)
+            return 1, Response({'message': 'minimum rating cannot exceed 5'},
+                               status=status.HTTP_400_BAD_REQUEST)
         max_dist = float(request.GET.get('dist', -1))
         lat = float(request.GET.get('lat', -1))
         long = float(request.GET.get('long', -1))
         sort_by = request.GET.get('sort_by', 'name')
-        day_of_the_week = int(request.GET.get('day_of_the_week', -1))
+        date = get_date(request.GET)
         start = int(request.GET.get('start_time', -1))
         end = int(request.GET.get('end_time', -1))
         if start > end:
-            return Response({'message': 'end time cannot precede start time'},
-                            status=status.HTTP_400_BAD_REQUEST)
+            return 1, Response({'message': 'end time cannot precede start time'},
+                               status=status.HTTP_400_BAD_REQUEST)
         rackets_count = int(request.GET.get('rackets_count', 0))
         shuttlecocks_count = int(request.GET.get('shuttlecocks_count', 0))
 
         if max_dist > -1 or sort_by == 'dist' or sort_by == '-dist':
             response = check_arguments(request.GET, ['lat', 'long', ])
             if response[0] != 0:
-                return response[1]
+                return response
 
-        if not request.user.is_staff:
-            queryset = Court.objects.exclude(
-                owner__extended__ban_list__id__icontains=request.user.id)
+        if rackets_count > 0 and (start < 0 or end < 0 or date is None):
+            return 1, Response({'message': 'Please provide date or day_of_the_week, start_time and end_time'},
+                               status=status.HTTP_400_BAD_REQUEST)
 
         queryset = queryset.filter(is_verified=True)
 
         if name != '':
-            queryset = queryset.filter(name__icontains=name)
-
-        if min_rating != -1:
-            queryset = [court for court in queryset if court.avg_score() >= min_rating]
+            queryset = filter_name(queryset, name)
 
         if max_dist != -1:
-            queryset = [court for court in queryset if
-                        (court.lat - lat) ** 2 + (court.long - long) ** 2 <= max_dist ** 2]
+            # max_dist is in km
+            queryset = within_distance(queryset, lat, long, max_dist)
+
+        if min_rating != -1:
+            queryset = queryset.filter(rating_sum__gte=F('rating_count') * min_rating)
+            if min_rating > 0:
+                queryset = queryset.filter(rating_count__gt=0)
 
         if rackets_count > 0:
-            if start < 0 or end < 0 or day_of_the_week < 0:
-                return Response({'message': 'Please provide day_of_the_week, start_time and end_time'},
-                                status=status.HTTP_400_BAD_REQUEST)
-            queryset = [court for court in queryset if
-                        len([racket for racket in court.rackets.all() if
-                             racket.check_collision(day_of_the_week, start, end) == 0])
-                        >= rackets_count]
+            queryset = queryset.annotate(
+                free_rackets_count=free_racket_count(date, start, end),
+            ).filter(free_rackets_count__gte=rackets_count)
 
         if shuttlecocks_count > 0:
-            queryset = [court for court in queryset if
-                        sum([shuttlecock.count for shuttlecock in
-                             court.shuttlecocks.all()]) >= shuttlecocks_count]
-
-        if day_of_the_week != -1 and start != -1 and end != -1:
-            queryset = [court for court in queryset if
-                        court.check_collision(day_of_the_week, start, end) == 0]
-
-        queryset = [court for court in queryset if court.open <= start and court.close >= end]
-
-        reverse = False
-        if sort_by[0] == '-':
-            reverse = True
-            sort_by = sort_by[1:]
+            queryset = queryset.annotate(shuttlecocks_total=Coalesce(Subquery(
+                Shuttlecock.objects.filter(court=OuterRef('pk')).order_by().values(
+                    'court').annotate(total=Sum('count')).values('total'),
+                output_field=IntegerField(),
+            ), 0)).filter(shuttlecocks_total__gte=shuttlecocks_count)
+
+        if date is not None and start != -1 and end != -1:
+            queryset = queryset.annotate(
+                free_court=has_free_court(date, start, end),
+            ).filter(free_court=True)
+
+        if start != -1:
+            queryset = queryset.filter(open__lte=start)
+        if end != -1:
+            queryset = queryset.filter(close__gte=end)
+
+        # the courts found so far are the same for every user, so they are
+        # shared through the search cache and the ban list applies after it
+        availability = rackets_count > 0 or (date is not None and start != -1 and end != -1)
+        ids = cached_court_ids([normalize(name), min_rating, max_dist, lat, long, date,
+                                start, end, rackets_count, shuttlecocks_count], queryset,
+                               availability)
+        if ids is not None:
+            queryset = Court.objects.filter(id__in=ids)
+
+        queryset = exclude_banned(queryset, request.user)
+
+        if (max_dist != -1 or sort_by in ('dist', '-dist')) \
+                and 'distance' not in queryset.query.annotations:
+            queryset = queryset.annotate(distance=distance_expression(lat, long))
+        return 0, queryset
+
+    @query_budget(5)
+    def list(self, request):
+        response = self.search_courts(request)
+        if response[0] != 0:
+            return response[1]
+        queryset = response[1]
 
+        sort_by = request.GET.get('sort_by', 'name')
+        descending = sort_by[0] == '-'
+        sort_by = sort_by.lstrip('-')
         if sort_by == 'dist':
-            sorted(queryset, key=lambda x: (x.lat - lat) ** 2 + (x.long - long) ** 2)
+            order = 'distance'
         elif sort_by == 'rating':
-            sorted(queryset, key=lambda x: x.avg_rating(), reverse=True)
-        elif sort_by == 'name':
-            sorted(queryset, key=lambda x: x.name, reverse=reverse)
-
-        serializer_class = CourtSerializer
-        return Response(serializer_class(queryset, many=True).data,
-                        status=status.HTTP_200_OK)
+            # best rated first; '-rating' puts the worst first
+            queryset = queryset.annotate(rating=Case(
+                When(rating_count=0, then=Value(0.0)),
+                default=Cast('rating_sum', FloatField()) / F('rating_count'),
+                output_field=FloatField(),
+            ))
+            order = 'rating'
+            descending = not descending
+        else:
+            order = 'name'
+        queryset = queryset.order_by(('-' if descending else '') + order, 'id')
+        queryset = queryset.annotate(first_image=Subquery(
+            Image.objects.filter(court=OuterRef('pk')).order_by('timestamp', 'id').values('url')[:1],
+        ))
+        expand = query_param_set(request, 'expand')
+        if settings.FAST_READ_PATH and not expand:
+            page = self.paginate_queryset(court_list_values(queryset))
+            return self.get_paginated_response(
+                [sparse(court, query_param_set(request, 'fields')) for court in court_list(page)])
+        if 'owner' in expand:
+            queryset = queryset.select_related('owner')
+        queryset = queryset.prefetch_related(*[name for name in ('images', 'reviews') if name in expand])
+
+        page = self.paginate_queryset(queryset)
+        serializer_class = CourtListSerializer
+        return self.get_paginated_response(
+            serializer_class(page, many=True, context={'request': request}).data)
 
 
 # TODO create class to view and cancel racket bookings
@@ -939,13 +1332,8 @@ class RacketViewSet(viewsets.ModelViewSet):
         if not user.is_staff and user != booking.user:
             return err_not_allowed
         price = racketBooking.price
-        dist = timedelta(days=booking.day_of_the_week) - \
-               timedelta(days=timezone.localtime(timezone.now()).weekday())
-        if dist < timedelta(days=0):
-            dist += timedelta(days=7)
-        effective_date = booking.booked_date + dist
-        effective_date.replace(hour=0, minute=0, second=0)
-        if timezone.localtime(timezone.now()) > effective_date:
+        dist = timedelta(days=booking.days_left)
+        if dist <= timedelta(days=0):
             # case 1: already past the date
             return Response(
                 {'message': 'Already past cancellation time'},
@@ -953,7 +1341,7 @@ class RacketViewSet(viewsets.ModelViewSet):
             )
         racketBooking.racket.unbooked(start=booking.start,
                                end=booking.end,
-                               day_of_the_week=booking.day_of_the_week)
+                               date=booking.date)
         if dist >= timedelta(days=0):
             # case 2: before the date
             refund = price
@@ -1001,13 +1389,8 @@ class ShuttlecockViewSet(viewsets.ModelViewSet):
         if not user.is_staff and user != booking.user:
             return err_not_allowed
         price = booking.price
-        dist = timedelta(days=booking.booking.day_of_the_week) - \
-               timedelta(days=timezone.localtime(timezone.now()).weekday())
-        if dist < timedelta(days=0):
-            dist += timedelta(days=7)
-        effective_date = booking.reserve_date + dist 
-        effective_date.replace(hour=0, minute=0, second=0)
-        if timezone.localtime(timezone.now()) > effective_date:
+        dist = timedelta(days=booking.booking.days_left)
+        if dist <= timedelta(days=0):
             # case 1: already past the date
             return Response(
                 {'message': 'Already past cancellation time'},
@@ -52,8 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    
-    
+    'api.querystats.QueryStatsMiddleware',
 ]
 
 ROOT_URLCONF = 'courtcatch.urls'
@@ -94,6 +93,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 # Password validation
@@ -134,4 +137,71 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
-CORS_ORIGIN_ALLOW_ALL = True
\ No newline at end of file
+CORS_ORIGIN_ALLOW_ALL = True
+
+# Number of days, starting today, that have court and racket schedules and
+# can be booked. Run `manage.py rollover_schedules` daily to move the window.
+
+BOOKING_HORIZON_DAYS = 28
+
+# Number of courts whose next week of availability is kept in memory by
+# each worker process.
+
+AVAILABILITY_CACHE_SIZE = 1024
+
+# Most slots one book_many request may book; a weekly recurrence is also
+# limited by BOOKING_HORIZON_DAYS.
+
+BOOK_MANY_MAX_SLOTS = 14
+
+# Function that orders the free court_numbers of a court for a booking,
+# see api/allocators.py.
+
+COURT_ALLOCATOR = 'api.allocators.best_fit'
+
+# Court search results are kept in the default cache for
+# SEARCH_CACHE_TIMEOUT seconds, unless they match more than
+# SEARCH_CACHE_MAX_IDS courts. Workers only share them, and their
+# invalidation, when CACHES points to a shared backend such as memcached.
+
+SEARCH_CACHE_TIMEOUT = 300
+SEARCH_CACHE_MAX_IDS = 1000
+SEARCH_CACHE_LOCK_TIMEOUT = 5
+
+# Ban lists are kept in the same cache for BAN_CACHE_TIMEOUT seconds. A ban
+# list change drops the cached entries of the process making it; the
+# timeout bounds how long other workers on a per-process cache miss it.
+
+BAN_CACHE_TIMEOUT = 60
+
+# QueryStatsMiddleware keeps the QUERY_STATS_SLOWEST slowest statements of
+# a request, cut to QUERY_STATS_SQL_LENGTH characters, for its log line and
+# the X-Query-* headers. It logs the requests over their query budget at
+# WARNING and every other request at INFO, which QUERY_STATS_LOG_LEVEL=INFO
+# turns on.
+
+QUERY_STATS_SLOWEST = 3
+QUERY_STATS_SQL_LENGTH = 300
+QUERY_STATS_LOG_LEVEL = os.environ.get('QUERY_STATS_LOG_LEVEL', 'WARNING')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api.queries': {
+            'handlers': ['console'],
+            'level': QUERY_STATS_LOG_LEVEL,
+        },
+    },
+}
+
+# Serve the court list, court detail and user profile GETs from values()
+# projections (api/projections.py) instead of the serializers, with the
+# same output.
+
+FAST_READ_PATH = True